@@ -0,0 +1,323 @@
+"""
+Times the hot paths against a local stand-in for the chat-completions API,
+so that changes can be compared run to run without network access.
+
+    python bench.py [scenario ...] [--latency S] [--tokens-per-second N]
+                    [--error-rate R] [--rate-limit-rate R] [--output results.jsonl]
+                    [--baseline results.jsonl]
+
+Scenarios: query (Gpt.query, one after another), stream (Gpt.stream),
+query_many (one fan-out at --concurrency), renamer (scanning synthetic
+folders of --sizes names and sending them through book-renamer's
+send_list) and translator (translator_server's segmented streaming path,
+first with an empty translation memory, then with the same text again).
+Each runs against its own fake_api.py process, and reports its throughput,
+the requests' latency percentiles and its peak Python heap (tracemalloc,
+which slows things down a bit; --no-memory leaves it off).
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import queue
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import gpt_lib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ["query", "stream", "query_many", "renamer", "translator"]
+AUTHORS = ["Ursula K. Le Guin", "Machado de Assis", "Italo Calvino", "Clarice Lispector", "Stanislaw Lem",
+           "Jorge Luis Borges", "Octavia E. Butler", "Gabriel Garcia Marquez", "Ted Chiang", "Olga Tokarczuk"]
+WORDS = ["the", "city", "of", "glass", "memory", "dispossessed", "invisible", "cities", "solaris", "river",
+         "stories", "life", "others", "night", "labyrinth", "kindred", "hour", "star", "dom", "casmurro"]
+NAME_PATTERNS = ["{author} - {title}", "{title} - {author} ({year})", "{title}_{author}_{year}",
+                 "{author}. {title} [{year}]", "{title} (z-lib.org)", "{title} {year} retail",
+                 "{author} {year} - {sentence}", # looks kept, but for the first name: the models' job
+                 "{last} {initials} {year} - {sentence}", "{author} - {sentence} ({year})"] # the last two: well kept
+
+
+class FakeServer:
+    """
+    fake_api.py in a process of its own, so that serving doesn't compete
+    with the client being measured for the GIL.
+    """
+
+    def __init__(self, args:argparse.Namespace, reply:str, reply_words:int=100) -> None:
+        self.process = subprocess.Popen([sys.executable, os.path.join(HERE, "fake_api.py"), "--port", "0",
+                                         "--latency", str(args.latency),
+                                         "--tokens-per-second", str(args.tokens_per_second),
+                                         "--error-rate", str(args.error_rate),
+                                         "--rate-limit-rate", str(args.rate_limit_rate),
+                                         "--reply", reply, "--reply-words", str(reply_words),
+                                         "--drop-rate", str(args.drop_rate), "--seed", str(args.seed)],
+                                        stdout=subprocess.PIPE, text=True)
+        self.base_url = self.process.stdout.readline().split()[-1]
+
+    def __enter__(self) -> "FakeServer":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.process.terminate()
+        self.process.wait()
+
+
+def synthetic_names(count:int, seed:int) -> list[str]:
+    rng = random.Random(seed)
+    names = []
+    for n in range(count):
+        title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))) + f" vol {n}" # n keeps them unique
+        author = rng.choice(AUTHORS)
+        name = rng.choice(NAME_PATTERNS).format(author=author, last=author.split()[-1],
+                                                initials="".join(word[0] for word in author.split()[:-1]),
+                                                title=title.title(), sentence=title.capitalize(),
+                                                year=rng.randint(1850, 2024))
+        names.append(name + rng.choice([".epub", ".pdf", ".mobi"]))
+    return names
+
+def synthetic_folder(folder:str, count:int, seed:int, per_dir:int=1000) -> None:
+    for n, name in enumerate(synthetic_names(count, seed)):
+        directory = os.path.join(folder, f"shelf {n // per_dir}")
+        if n % per_dir == 0:
+            os.makedirs(directory)
+        open(os.path.join(directory, name), "w").close()
+
+def load_book_renamer():
+    spec = importlib.util.spec_from_file_location("book_renamer", os.path.join(HERE, "book-renamer.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def stub_desktop_modules() -> list[str]:
+    """
+    Stands in for whichever of the modules translator_server imports for its
+    clipboard, keystrokes and toasts are missing, so that its translation path
+    can be timed on any machine; the bench never calls them. Returns their names.
+    """
+
+    class WindowsToaster:
+        def __init__(self, name):
+            pass
+
+        def clear_toasts(self):
+            pass
+
+        def show_toast(self, toast):
+            pass
+
+    stubs = {"pyperclip": {"paste": lambda: "", "copy": lambda text: None},
+             "keyboard": {"write": lambda text: None, "is_pressed": lambda key: False},
+             "windows_toasts": {"Toast": lambda *args, **kwargs: None, "WindowsToaster": WindowsToaster,
+                                "ToastDuration": types.SimpleNamespace(Short="Short", Long="Long")}}
+    stubbed = []
+    for name, attributes in stubs.items():
+        if name in sys.modules or importlib.util.find_spec(name) is not None:
+            continue
+        module = types.ModuleType(name)
+        module.__dict__.update(attributes)
+        sys.modules[name] = module
+        stubbed.append(name)
+    return stubbed
+
+
+@contextlib.contextmanager
+def measured(result:dict, memory:bool):
+    """
+    Fills in `result`'s wall time and, with `memory`, its peak Python heap.
+    """
+
+    if memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        result["seconds"] = time.perf_counter() - started
+        if memory:
+            result["peak_heap_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+
+def agent(server:FakeServer, stats:gpt_lib.MetricsStats, model:str=None, assignment:str="") -> gpt_lib.Gpt:
+    return gpt_lib.Gpt(assignment, model=model, base_url=server.base_url, key="fake", metrics=[stats])
+
+
+def bench_query(args:argparse.Namespace, stats:gpt_lib.MetricsStats, result:dict) -> None:
+    with FakeServer(args, "lorem", args.reply_words) as server:
+        gpt = agent(server, stats)
+        with measured(result, args.memory):
+            for n in range(args.requests):
+                gpt.query(f"question {n}")
+    result["requests_per_second"] = args.requests / result["seconds"]
+
+def bench_stream(args:argparse.Namespace, stats:gpt_lib.MetricsStats, result:dict) -> None:
+    with FakeServer(args, "lorem", args.reply_words) as server:
+        gpt = agent(server, stats)
+        deltas = 0
+        with measured(result, args.memory):
+            for n in range(args.requests):
+                for _ in gpt.stream(f"question {n}"):
+                    deltas += 1
+    result["requests_per_second"] = args.requests / result["seconds"]
+    result["deltas_per_second"] = deltas / result["seconds"]
+
+def bench_query_many(args:argparse.Namespace, stats:gpt_lib.MetricsStats, result:dict) -> None:
+    with FakeServer(args, "lorem", args.reply_words) as server:
+        gpt = agent(server, stats)
+        with measured(result, args.memory):
+            replies = gpt.query_many([f"question {n}" for n in range(args.requests)],
+                                     concurrency=args.concurrency, return_exceptions=True)
+    result["failed"] = sum(isinstance(reply, gpt_lib.GptError) for reply in replies)
+    result["requests_per_second"] = args.requests / result["seconds"]
+
+def bench_renamer(args:argparse.Namespace, stats:gpt_lib.MetricsStats, result:dict, size:int) -> None:
+    renamer = load_book_renamer()
+    with FakeServer(args, "rename") as server, tempfile.TemporaryDirectory() as folder:
+        synthetic_folder(folder, size, args.seed)
+        agents = {model: agent(server, stats, model, renamer.PROMPT) for model in renamer.MODELS}
+
+        with measured(result, args.memory), open(os.devnull, "w") as devnull:
+            scan_started = time.perf_counter()
+            files = list(renamer.scan(folder))
+            result["scan_seconds"] = time.perf_counter() - scan_started
+            with contextlib.redirect_stdout(devnull): # send_list prints every name
+                reports = renamer.send_list(files, agents)
+
+    result["names"] = size
+    result["names_per_second"] = size / result["seconds"]
+    local = [file for file in files if renamer.CONFORMANT_NAME.match(file["name"]) or renamer.LOCAL in file["suggestions"]]
+    asked = len(files) - len(local)
+    result["clusters"] = len(reports)
+    result["resolved_locally"] = len(local) / size
+    result["named"] = sum(len(file["suggestions"]) for file in files if file not in local) \
+                      / (asked * len(renamer.MODELS)) if asked else 1.0
+
+def bench_translator(args:argparse.Namespace, stats:gpt_lib.MetricsStats, result:dict) -> None:
+    stubbed = stub_desktop_modules()
+    if stubbed:
+        result["stubbed"] = ", ".join(stubbed)
+    import translator
+    from translator_server import Translator_Server, segment
+    from translation_memory import TranslationMemory
+
+    paragraphs = [" ".join(random.Random(args.seed + n).choices(WORDS, k=60)).capitalize() + "."
+                  for n in range(args.paragraphs)]
+    text = "\n\n".join(paragraphs)
+
+    with FakeServer(args, "lorem", args.reply_words) as server, tempfile.TemporaryDirectory() as tempdir:
+        # Just what translate_segments uses: no listener, clipboard or keystrokes.
+        translation_server = Translator_Server.__new__(Translator_Server)
+        translation_server.target_language = translator.DEFAULT_L2
+        translation_server.gpts = queue.Queue()
+        for _ in range(translator.SEGMENT_WORKERS):
+            translation_server.gpts.put(agent(server, stats, translator.MODEL, translator.assignment))
+        translation_server.segment_pool = ThreadPoolExecutor(translator.SEGMENT_WORKERS)
+        translation_server.memory = TranslationMemory(os.path.join(tempdir, "memory.sqlite"),
+                                                      threshold=translator.FUZZY_THRESHOLD)
+
+        with measured(result, args.memory):
+            for run in ["cold", "warm"]: # warm: all from the translation memory
+                started = time.perf_counter()
+                first_delta, characters = None, 0
+                for delta in translation_server.translate_segments(segment(text)):
+                    first_delta = first_delta or time.perf_counter() - started
+                    characters += len(delta)
+                result[f"{run}_first_delta_seconds"] = first_delta
+                result[f"{run}_seconds"] = time.perf_counter() - started
+                result[f"{run}_characters_per_second"] = characters / result[f"{run}_seconds"]
+
+        translation_server.segment_pool.shutdown()
+        translation_server.memory.close()
+    result["segments"] = len(segment(text))
+
+
+def run(scenario:str, args:argparse.Namespace, **kwargs) -> dict:
+    stats = gpt_lib.MetricsStats(window=10**6)
+    result = {"scenario": scenario, **kwargs}
+    globals()[f"bench_{scenario}"](args, stats, result, **kwargs)
+    result["models"] = stats.summary()
+    return result
+
+def report(result:dict, baseline:dict=None) -> None:
+    label = result["scenario"] + (f" {result['names']}" if "names" in result else "")
+    if "stubbed" in result:
+        label += f" (stand-ins for {result['stubbed']})"
+
+    figures = {name: value for name, value in result.items()
+               if isinstance(value, (int, float)) and not isinstance(value, bool) and name != "size"}
+    print(f"{label}:")
+    for name, value in figures.items():
+        change = ""
+        if baseline and baseline.get(name):
+            change = f"  ({(value - baseline[name]) / baseline[name]:+.0%} on the baseline)"
+        print(f"    {name:32} {value:12.3f}{change}")
+    for model, model_stats in result["models"].items():
+        latency = model_stats["latency"] or {}
+        ttft = model_stats["ttft"] or {}
+        print(f"    {model}: {model_stats['requests']} requests, {model_stats['retries']} retries, "
+              f"{sum(model_stats['errors'].values())} failed; latency " +
+              " ".join(f"{q} {value * 1000:.0f}ms" for q, value in latency.items()) +
+              "; first token " + " ".join(f"{q} {value * 1000:.0f}ms" for q, value in ttft.items()))
+
+def read_baseline(path:str) -> dict:
+    """
+    The latest result of each scenario (and size) in a previous --output file.
+    """
+
+    baseline = {}
+    with open(path) as file:
+        for line in file:
+            result = json.loads(line)
+            baseline[(result["scenario"], result.get("size"))] = result
+    return baseline
+
+def read_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark against a local fake chat-completions server.")
+    parser.add_argument("scenarios", nargs="*", default=SCENARIOS, help=f"any of {', '.join(SCENARIOS)}")
+    parser.add_argument("--latency", type=float, default=.05, help="seconds before each reply")
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="streaming rate, 0 for no limit")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of requests failing with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="share of requests getting a 429")
+    parser.add_argument("--drop-rate", type=float, default=0, help="share of names the fake renamer leaves out")
+    parser.add_argument("--reply-words", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=200, help="for query, stream and query_many")
+    parser.add_argument("--concurrency", type=int, default=gpt_lib.DEFAULT_CONCURRENCY)
+    parser.add_argument("--sizes", default="1000,10000,100000", help="names per renamer folder")
+    parser.add_argument("--paragraphs", type=int, default=40, help="of the translated text")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="skip tracemalloc")
+    parser.add_argument("--output", help="append the results to this JSONL file")
+    parser.add_argument("--baseline", help="compare with the latest results in this JSONL file")
+    args = parser.parse_args()
+    if unknown := set(args.scenarios) - set(SCENARIOS):
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+def main() -> int:
+    args = read_args()
+    baseline = read_baseline(args.baseline) if args.baseline else {}
+
+    results = []
+    for scenario in args.scenarios:
+        for kwargs in [{"size": int(size)} for size in args.sizes.split(",")] if scenario == "renamer" else [{}]:
+            results.append(run(scenario, args, **kwargs))
+            report(results[-1], baseline.get((scenario, kwargs.get("size"))))
+
+    if args.output:
+        settings = {name: value for name, value in vars(args).items() if name not in ("output", "baseline")}
+        with open(args.output, "a") as output:
+            for result in results:
+                output.write(json.dumps(dict(result, time=time.time(), settings=settings)) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""
+Guards the translator client's startup time, which every hotkey press pays.
+
+    python bench_startup.py [repeats]
+
+Checks that importing translator pulls in none of the server's heavy modules,
+measures its import time (-X importtime) and the wall time of a whole client
+call against a stand-in server, and exits with 1 if any budget is exceeded.
+"""
+
+import json
+import os
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HEAVY_MODULES = {"gpt_lib", "translator_server", "openai", "httpx", "pyperclip", "keyboard", "windows_toasts", "sqlite3"}
+IMPORT_BUDGET_MS = 30  # importing translator, cumulative
+CLIENT_BUDGET_MS = 120 # interpreter start to acknowledged call
+
+
+def run_python(*args:str, env:dict=None) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *args], cwd=HERE, env=env, capture_output=True, text=True, check=True)
+
+def heavy_imports() -> set:
+    result = run_python("-c", "import sys, translator; print(' '.join(sys.modules))")
+    return HEAVY_MODULES & set(result.stdout.split())
+
+def import_time_ms() -> float:
+    result = run_python("-X", "importtime", "-c", "import translator")
+    for line in result.stderr.splitlines():
+        _, _, timings = line.partition("import time:")
+        fields = [field.strip() for field in timings.split("|")]
+        if len(fields) == 3 and fields[2] == "translator":
+            return int(fields[1]) / 1000
+    raise RuntimeError("translator missing from -X importtime output")
+
+def serve_acks(listener:socket.socket) -> None:
+    while True:
+        try:
+            connection, _ = listener.accept()
+        except OSError:
+            return
+        with connection:
+            length, = struct.unpack(">I", connection.recv(4))
+            connection.recv(length)
+            payload = json.dumps({"status": "queued", "position": 1}).encode()
+            connection.sendall(struct.pack(">I", len(payload)) + payload)
+
+def client_call_ms() -> float:
+    with tempfile.TemporaryDirectory() as tempdir:
+        listener = socket.create_server(("127.0.0.1", 0))
+        threading.Thread(target=serve_acks, args=(listener,), daemon=True).start()
+        with open(os.path.join(tempdir, "gpt_translator.port"), "w") as portfile:
+            portfile.write(str(listener.getsockname()[1]))
+
+        env = dict(os.environ, TMPDIR=tempdir, TEMP=tempdir, TMP=tempdir) # where translator looks for the port
+        started = time.perf_counter()
+        result = run_python("translator.py", "-c", env=env)
+        elapsed = (time.perf_counter() - started) * 1000
+        listener.close()
+
+    if "queued" not in result.stdout:
+        raise RuntimeError(f"the client didn't reach the stand-in server:\n{result.stdout}{result.stderr}")
+    return elapsed
+
+def main() -> int:
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    failures = []
+
+    heavy = heavy_imports()
+    print(f"heavy modules imported by the client: {sorted(heavy) or 'none'}")
+    if heavy:
+        failures.append("heavy imports")
+
+    import_ms = statistics.median(import_time_ms() for _ in range(repeats))
+    print(f"import translator: {import_ms:.1f} ms (budget {IMPORT_BUDGET_MS} ms)")
+    if import_ms > IMPORT_BUDGET_MS:
+        failures.append("import time")
+
+    client_ms = statistics.median(client_call_ms() for _ in range(repeats))
+    print(f"client call:       {client_ms:.1f} ms (budget {CLIENT_BUDGET_MS} ms)")
+    if client_ms > CLIENT_BUDGET_MS:
+        failures.append("client call time")
+
+    if failures:
+        print(f"over budget: {', '.join(failures)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,15 @@
 import PySimpleGUI as sg
+import argparse
 import gpt_lib as opr
+import json
 import os
+import queue
 import threading
 import re
 import sys
+import time
+import unicodedata
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 KEY = "<your key>"
 
@@ -11,6 +17,23 @@ NAME_PATTERN = "Last-Name Other-Initials Original-Publication-Year <hyphen> Titl
 UGLY_NAME    = "(Series or Other Information 36) John Doe - The Title of the Book, Part 2.1 - The Book's Subtitle-Publisher's Name (1954-1955) c"
 PRETTY_NAME  = "Doe J 1954-55 - Title of the book, 2.1_ Book's subtitle"
 MODELS = ["anthropic/claude-3.5-sonnet", "openai/gpt-4o"]
+LOCAL = "local parser" # suggests names it can work out by itself, before any model is asked
+SOURCES = [LOCAL] + MODELS
+CONCURRENCY = 8 # clusters in flight per model
+CLUSTER_TOKENS     = 600  # initial token budget of the names sent in one request
+MIN_CLUSTER_TOKENS = 100
+MAX_CLUSTER_TOKENS = 4000
+MAX_REREQUESTS = 2 # times a name the model skipped is sent again
+REPLY_LINE = re.compile(r"^\s*(\d+)\s*:(.*)$")
+SCAN_BATCH = 200 # files sent to the models at a time, while the scan goes on
+BATCH_WORKERS = 2 # scan batches being suggested at once
+POLL_INTERVAL = 100 # ms between checks for new suggestions in the review window
+BATCH_CLUSTER_TOKENS = 2000 # fixed: a batch job can't adapt to how well the model copes
+BATCH_POLL_INTERVAL = 60 # s between checks on running batch jobs
+INDEX_FILENAME = ".book-renamer.json"
+INDEX_SAVE_INTERVAL = 30 # s between rewrites of the index while a run goes on; it is saved at the end regardless
+REQUESTS_PER_MINUTE = 60      # per model, shared by everything in this process
+TOKENS_PER_MINUTE   = 200_000
 
 PROMPT = f"""
     You are a data processor and archivist.
@@ -30,44 +53,353 @@ PROMPT = f"""
     Here is the list:\n
 """
 
-def create_agent(model, agents):
-    agents[model] = opr.Gpt(model=model, assignment=PROMPT, key=KEY)
-
-def send_list(files:list, agents:dict, cluster_size:int=10) -> None:
+METRICS = opr.MetricsStats() # every agent's requests, by model
+
+def create_agent(model, agents, cache=None):
+    agents[model] = opr.Gpt(model=model, assignment=PROMPT, key=KEY, cache=cache, metrics=[METRICS],
+                            requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE)
+
+def print_metrics() -> None:
+    for model, stats in METRICS.summary().items():
+        latency = stats["latency"] or {}
+        print(f"{model}: {stats['requests']} requests ({stats['cached']} cached, {stats['retries']} retries, "
+              f"{sum(stats['errors'].values())} failed), {stats['completion_tokens']} tokens out, "
+              f"latency p50 {latency.get('p50', 0):.2f}s p90 {latency.get('p90', 0):.2f}s")
+
+class Batcher:
+    """
+    Packs numbered names into clusters of at most `budget` estimated tokens.
+    The budget grows while a model answers with one line per name,
+    and is halved whenever it doesn't.
+    """
+
+    def __init__(self, budget:int=CLUSTER_TOKENS, min_budget:int=MIN_CLUSTER_TOKENS, max_budget:int=MAX_CLUSTER_TOKENS):
+        self.budget = budget
+        self.min_budget = min_budget
+        self.max_budget = max_budget
+
+    def next_cluster(self, names:list, start:int) -> list:
+        end, tokens = start, 0
+        while end < len(names):
+            tokens += opr.estimate_tokens(names[end])
+            if tokens > self.budget and end > start:
+                break
+            end += 1
+        return names[start:end]
+
+    def feedback(self, well_formed:bool) -> None:
+        if well_formed:
+            self.budget = min(int(self.budget * 1.25), self.max_budget)
+        else:
+            self.budget = max(self.budget // 2, self.min_budget)
+
+BATCHERS = {model: Batcher() for model in MODELS} # for the whole run, so what they learn carries over scan batches
+
+# A name already in NAME_PATTERN: "Doe J 1954-55 - Title of the book, 2.1_ Book's subtitle"
+CONFORMANT_NAME = re.compile(r"""^_?[A-Z][\w'’]+(?:-[A-Z][\w'’]+)*          # last name,
+                                 (?:(?:\ [A-Z][\w'’]+(?:-[A-Z][\w'’]+)*)+?  # of several words only
+                                    (?=\ [A-Z]{1,4}\b|\ et\ al\b)           # before initials: not "Isaac Asimov"
+                                  |(?=\ [A-Z]{1,4}\b|\ et\ al\b|\ \d{4}))   # (one of the next three at least)
+                                 (?:\ [A-Z]{1,4}|\ et\ al)?                 # initials
+                                 (?:\ \d{4}(?:-\d{2})?!?)?                  # year(s)
+                                 _?\ -\ (?!(?:The|An?)\ )[^\s_].*$          # title, without its article""", re.VERBOSE)
+NAME_NOISE = re.compile(r"\s*[(\[](?:z-lib(?:\.org)?|z-library|libgen(?:\.\w+)?|retail|epub|pdf|mobi|ebook)[)\]]",
+                        re.IGNORECASE)
+TRAILING_YEARS = re.compile(r"\s*[(\[](\d{4})(?:-(\d{2}|\d{4}))?[)\]]$")
+NAME_WORD = re.compile(r"^(?:[A-Z][a-z'’]+(?:-[A-Z][a-z'’]+)*|[A-Z]\.)$") # "Ursula", "Jean-Paul", "K."
+ARTICLE = re.compile(r"^(?:The|An?) (?=\w)")
+
+def looks_like_person(words:list[str]) -> bool:
+    """
+    "First [I.]* Last": more than one full name before the last one
+    ("Ursula K. Le Guin", "Gabriel Garcia Marquez") leaves the surname in doubt.
+    """
+
+    full_names = [word for word in words[:-1] if not word.endswith(".")]
+    return 2 <= len(words) <= 5 and len(full_names) <= 1 and all(NAME_WORD.match(word) for word in words) \
+           and not words[-1].endswith(".")
+
+def sentence_cased(text:str) -> bool:
+    """
+    Whether only the first word is capitalized (acronyms and numbers aside),
+    since turning Title Case into sentence case needs to know the proper nouns.
+    """
+
+    return not any(re.match(r"^[A-Z][a-z]", word) for word in re.split(r"[\s,]+", text)[1:])
+
+def parse_name(name:str) -> str | None:
+    """
+    NAME_PATTERN from names like "Ursula K. Le Guin - The dispossessed (1974)",
+    "Lem, Stanislaw - Solaris [1961]" or "Italo Calvino - Invisible cities - Subtitle",
+    or None when there's any doubt about which part is which.
+    """
+
+    name = NAME_NOISE.sub("", name).strip()
+    year = ""
+    if match := TRAILING_YEARS.search(name):
+        year = match[1] + (f"-{match[2][-2:]}" if match[2] else "")
+        name = name[:match.start()]
+
+    parts = name.split(" - ")
+    if not 2 <= len(parts) <= 3 or "_" in name:
+        return None
+    author, title = parts[0].strip(), parts[1].strip()
+    subtitle = parts[2].strip() if len(parts) == 3 else ""
+    if not subtitle and ": " in title:
+        title, subtitle = title.split(": ", 1)
+
+    if author.count(",") == 1: # "Last, First Middle", where the surname can't be mistaken
+        last, first = (part.strip() for part in author.split(","))
+        first_names = first.split()
+        if not last or not all(NAME_WORD.match(word) for word in [*first_names, *last.split()]) \
+                or not 1 <= len(first_names) <= 4:
+            return None
+    else:
+        words = author.split()
+        if not looks_like_person(words) or all(NAME_WORD.match(word) for word in title.split()):
+            return None # a title all in capitals could be "Title - Author" the other way around
+        first_names, last = words[:-1], words[-1]
+
+    if not title or not sentence_cased(title) or subtitle and not sentence_cased(subtitle) \
+            or re.search(r"[()\[\]{}]", title + subtitle): # leftovers of who knows what
+        return None
+    title = ARTICLE.sub("", title)
+    subtitle = ARTICLE.sub("", subtitle)
+
+    initials = "".join(first_name[0] for first_name in first_names)
+    new_name = f"{last} {initials}" + (f" {year}" if year else "") + f" - {title[0].upper()}{title[1:]}"
+    return new_name + (f"_ {subtitle[0].upper()}{subtitle[1:]}" if subtitle else "")
+
+def resolve_locally(files:list) -> list:
+    """
+    Sorts out the files that need no model: those already named after
+    NAME_PATTERN are left alone, those parse_name can work out get its name
+    as their only suggestion. Returns the rest, which are up to the models.
+    """
+
+    ambiguous = []
+    for file in files:
+        if CONFORMANT_NAME.match(file["name"]):
+            file["suggestions"] = {}
+        elif parsed := parse_name(file["name"]):
+            file["suggestions"] = {LOCAL: parsed}
+        else:
+            ambiguous.append(file)
+            continue
+        file["new_names"] = distinct_names(file)
+
+    if files:
+        resolved = len(files) - len(ambiguous)
+        print(f"{resolved} of {len(files)} names resolved locally ({resolved / len(files):.0%})")
+    return ambiguous
+
+COPY_SUFFIX = re.compile(r"\s*\((\d{1,2})\)$")               # "Title (1)", as downloads get renamed
+UNNUMBERED_TAG = re.compile(r"\s*(?:\([^()\d]*\)|\[[^\[\]\d]*\])") # "(z-lib.org)", "[Penguin Classics]"
+
+def duplicate_key(name:str) -> str:
+    """
+    What's left of a name without case, accents, punctuation and tags;
+    tags with numbers in them (years, volumes) stay.
+    """
+
+    name = UNNUMBERED_TAG.sub("", name.strip())
+    name = unicodedata.normalize("NFKD", name.casefold())
+    name = "".join(character for character in name if not unicodedata.combining(character))
+    return " ".join(re.sub(r"[\W_]+", " ", name).split())
+
+def sorting_key(file:dict) -> tuple:
+    """
+    Brings a directory's likely duplicates together, download copies included.
+    """
+
+    return file["dir"], duplicate_key(COPY_SUFFIX.sub("", file["name"]))
+
+def group_duplicates(files:list) -> list[list]:
+    """
+    Groups the files whose names only differ in their duplicate_key, like
+    the .pdf and .epub of a book. So do download copies: "Title (2)" is one
+    when there's a "Title" and a "Title (1)" too, and otherwise maybe a volume.
+    Each file's "group" is the list of them all.
+    """
+
+    keys, numbered = [], {} # numbered: {key without the suffix: its numbers}
+    for file in files:
+        copy = COPY_SUFFIX.search(file["name"])
+        if copy:
+            base_key = duplicate_key(file["name"][:copy.start()])
+            numbered.setdefault(base_key, set()).add(int(copy[1]))
+            keys.append((base_key, int(copy[1])))
+        else:
+            keys.append((duplicate_key(file["name"]), None))
+    unnumbered = {key for key, number in keys if number is None}
+
+    groups = {}
+    for file, (key, number) in zip(files, keys):
+        if number is not None and not (key in unnumbered and numbered[key] >= set(range(1, number))):
+            key = duplicate_key(file["name"]) # not a copy after all
+        groups.setdefault(key or file["name"], []).append(file)
+    for group in groups.values():
+        for file in group:
+            file["group"] = group
+    return list(groups.values())
+
+def send_list(files:list, agents:dict, batchers:dict=None) -> list[dict]:
+    """
+    Fills in every file's "new_names", asking about one file per group of
+    duplicates, and asking the models only about those that can't be
+    resolved locally; returns the validation report of each cluster sent.
+    """
+
+    groups = group_duplicates(files)
+    if len(groups) < len(files):
+        print(f"{len(files)} files in {len(groups)} groups of duplicates")
+    representatives = [min(group, key=lambda file: len(file["name"])) for group in groups] # the least cluttered
+    try:
+        return send_names(representatives, agents, batchers)
+    finally:
+        for group, representative in zip(groups, representatives): # its extension aside, a duplicate's name is the same
+            for file in group:
+                if file is not representative:
+                    file["suggestions"] = dict(representative["suggestions"])
+                    file["new_names"] = distinct_names(file)
+
+def send_names(files:list, agents:dict, batchers:dict=None) -> list[dict]:
+    batchers = batchers or BATCHERS
+    files = resolve_locally(files)
+    if not files:
+        return []
     numbered_names = [f"{n}:{file['name']}" for n, file in enumerate(files)]
-    suggestions = {model: [] for model in MODELS}
+    suggestions = {model: {} for model in MODELS}
+    reports = []
     thread = {model: [] for model in MODELS}
 
     for model in MODELS:
             thread[model] = threading.Thread(target=query_agent,
-                                             args=(agents, model, numbered_names, cluster_size, suggestions))
+                                             args=(agents, model, numbered_names, batchers[model], suggestions, reports))
             thread[model].start()
 
     for model in MODELS:
             thread[model].join()
 
-    for file in files:
-        seen = set()
-        seen.add(file["name"])
+    for n, file in enumerate(files):
         print(f"{file['name'] =}")
-        for model in MODELS: #todo this was probably just a very poor model acting up.
-            s = suggestions[model].pop(0).strip()
-            s = re.sub(r"   *", " ", s)
-            try:
-                s2 = s.split(':', 1)[1]
-                if s2 not in seen:
-                    file["new_names"][model] = s2
-                    seen.add(s2)
-            except IndexError:
-                pass #TODO
-
-
-
-def query_agent(agents:dict, model:str, array:list, cluster_size:int, output:dict) -> list:
-    for n in range(0, len(array), cluster_size):
-        message_cluster = "\n".join(array[n:n+cluster_size])
-        response = agents[model].ask(message_cluster)
-        output[model] += response.split("\n")
+        file["suggestions"] = {}
+        for model in MODELS:
+            s = suggestions[model].get(n)
+            if s is None:
+                continue
+            s = clean_suggestion(s)
+            if s:
+                file["suggestions"][model] = s
+        file["new_names"] = distinct_names(file)
+
+    flawed = [report for report in reports if not report["well_formed"]]
+    print(f"{len(reports)} clusters sent, {len(flawed)} with flawed replies")
+    return reports
+
+def clean_suggestion(suggestion:str) -> str:
+    return re.sub(r"   *", " ", suggestion.strip())
+
+def distinct_names(file:dict) -> dict:
+    """
+    The models' suggestions for `file`, minus repeats and its current name.
+    """
+
+    new_names, seen = {}, {file["name"]}
+    for model, suggestion in file["suggestions"].items():
+        if suggestion not in seen:
+            new_names[model] = suggestion
+            seen.add(suggestion)
+    return new_names
+
+def normalized(name:str) -> str:
+    name = re.sub(r"[‐‑‒–—]", "-", name.casefold())
+    name = re.sub(r"\s*([-_,.:;!])\s*", r"\1", name)
+    return re.sub(r"\s+", " ", name).strip()
+
+def agreement(file:dict) -> tuple[float, str | None]:
+    """
+    The share of MODELS backing the most popular suggestion (after
+    normalization), and that suggestion as the first of them put it.
+    The local parser only ever suggests names it's sure of.
+    """
+
+    if LOCAL in file["suggestions"]:
+        return 1.0, file["suggestions"][LOCAL]
+    votes = {}
+    for suggestion in file["suggestions"].values():
+        votes.setdefault(normalized(suggestion), []).append(suggestion)
+    if not votes:
+        return 0.0, None
+    backers = max(votes.values(), key=len)
+    return len(backers) / len(MODELS), backers[0]
+
+def parse_reply(reply:str, expected:dict) -> tuple[dict, dict]:
+    """
+    Maps each "N:new name" line of `reply` to its index N, keeping only the
+    indices in `expected`; also reports whatever didn't fit.
+    """
+
+    answers, unexpected, duplicates, unparsed = {}, [], [], 0
+    for line in reply.split("\n"):
+        if not line.strip():
+            continue
+        match = REPLY_LINE.match(line)
+        if not match:
+            unparsed += 1
+            continue
+        n, name = int(match[1]), match[2].strip()
+        if n not in expected:
+            unexpected.append(n)
+        elif n in answers:
+            duplicates.append(n)
+        else:
+            answers[n] = name
+
+    missing = sorted(expected.keys() - answers.keys())
+    report = {"expected": len(expected), "matched": len(answers), "missing": missing,
+              "unexpected": unexpected, "duplicates": duplicates, "unparsed": unparsed,
+              "well_formed": not (missing or unexpected or duplicates or unparsed)}
+    return answers, report
+
+def query_agent(agents:dict, model:str, array:list, batcher:Batcher, output:dict, reports:list) -> None:
+    """
+    Sends `array` in waves of CONCURRENCY clusters, so that each wave is
+    sized by how well the model handled the previous one.
+    Names the model skipped are sent again, up to MAX_REREQUESTS times.
+    """
+
+    todo, position = list(array), 0
+    attempts = {}
+    while position < len(todo):
+        clusters = []
+        while position < len(todo) and len(clusters) < CONCURRENCY:
+            clusters.append(batcher.next_cluster(todo, position))
+            position += len(clusters[-1])
+
+        responses = agents[model].query_many(["\n".join(cluster) for cluster in clusters],
+                                             concurrency=CONCURRENCY, return_exceptions=True)
+        for cluster, response in zip(clusters, responses):
+            expected = {int(name.split(":", 1)[0]): name for name in cluster}
+            if isinstance(response, opr.GptError):
+                answers, report = {}, {"expected": len(expected), "matched": 0, "missing": sorted(expected),
+                                       "error": str(response), "well_formed": False}
+            else:
+                answers, report = parse_reply(response, expected)
+                batcher.feedback(report["well_formed"])
+                if not report["well_formed"]: # or the name it skipped would be re-requested from the cache
+                    agents[model].uncache("\n".join(cluster))
+
+            output[model].update(answers)
+            report["model"] = model
+            reports.append(report)
+            if not report["well_formed"]:
+                print(f"{model}: {report}")
+
+            for n in report["missing"]:
+                attempts[n] = attempts.get(n, 0) + 1
+                if attempts[n] <= MAX_REREQUESTS:
+                    todo.append(expected[n])
 
 def new_full_name(file:dict, new_name:str=None, article:bool=False, anthology:bool=False) -> str:
     new_name = new_name or (list(file["new_names"].values())[0] if file["new_names"] else file["name"])
@@ -78,44 +410,506 @@ def new_full_name(file:dict, new_name:str=None, article:bool=False, anthology:bo
         new_name = f"_{new_name}"
     return f"{new_name}{file['ext']}"
 
-def iterate(files:list) -> tuple:
-    if not files:
-        return None, None
+def scan(folder:str):
+    """
+    Yields the files under `folder` directory by directory, each with its
+    directory relative to `folder`, and in sorting_key order within it.
+    """
+
+    pending_dirs = [""]
+    while pending_dirs:
+        relative_dir = pending_dirs.pop()
+        try:
+            entries = os.scandir(os.path.join(folder, relative_dir))
+        except OSError as e:
+            print(f"Can't scan {relative_dir or folder}: {e}")
+            continue
+
+        files = []
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending_dirs.append(os.path.join(relative_dir, entry.name))
+                elif entry.is_file() and entry.name != INDEX_FILENAME:
+                    stat = entry.stat()
+                    files.append({"dir":  relative_dir,
+                                  "name": os.path.splitext(entry.name)[0],
+                                  "ext":  os.path.splitext(entry.name)[1],
+                                  "size": stat.st_size,
+                                  "mtime": stat.st_mtime,
+                                  "suggestions": {},
+                                  "new_names": {}})
+        yield from sorted(files, key=sorting_key)
+
+def batched(iterable, size:int, key=None):
+    """
+    Lists of `size` items, or a few more so as not to split a run of items
+    with the same `key`.
+    """
+
+    batch = []
+    for item in iterable:
+        if len(batch) >= size and (key is None or key(item) != key(batch[-1])):
+            yield batch
+            batch = []
+        batch.append(item)
+    if batch:
+        yield batch
+
+def relative_path(file:dict, full_name:str=None) -> str:
+    return os.path.join(file["dir"], full_name or file["name"] + file["ext"])
+
+def settled(name:str, suggestions:dict) -> bool:
+    """
+    Whether a file got somewhere: suggestions, or a name that needs none.
+    A file whose requests all failed isn't, and is asked about again next time.
+    """
+
+    return bool(suggestions) or bool(CONFORMANT_NAME.match(name))
+
+class RenameIndex:
+    """
+    What became of each file in earlier runs, saved beside the files as
+    {relative path: {"size", "mtime", "suggestions", "decision"}}.
+    An entry only counts while the file's size and mtime still match it.
+    """
+
+    def __init__(self, folder:str):
+        self.path = os.path.join(folder, INDEX_FILENAME)
+        self.lock = threading.Lock() # suggestions and decisions are recorded from different threads
+        self.changed = False
+        self.saved_at = time.monotonic()
+        try:
+            with open(self.path, encoding="utf-8") as index_file:
+                self.entries = json.load(index_file)
+        except FileNotFoundError:
+            self.entries = {}
+
+    def lookup(self, file:dict) -> dict | None:
+        with self.lock:
+            entry = self.entries.get(relative_path(file))
+        if not entry or entry["size"] != file["size"] or entry["mtime"] != file["mtime"]:
+            return None
+        if entry["decision"] is None and not settled(file["name"], entry["suggestions"]):
+            return None # recorded by an earlier version, although the models failed on it
+        return entry
+
+    def record(self, file:dict, decision:str=None, new_name:str=None) -> None:
+        """
+        `decision` is "renamed" (to `new_name`, extension included) or "skipped".
+        """
+
+        entry = {"size": file["size"], "mtime": file["mtime"],
+                 "suggestions": file["suggestions"], "decision": decision}
+        with self.lock:
+            if new_name:
+                self.entries.pop(relative_path(file), None)
+            self.entries[relative_path(file, new_name)] = entry
+            self.changed = True
+
+    def save(self, force:bool=False) -> None:
+        """
+        Rewrites the whole index if it changed; unless `force`d, only once
+        INDEX_SAVE_INTERVAL has passed since the last time, as on a big
+        library saving after every batch or click would cost more than the scan.
+        """
+
+        temporary_path = f"{self.path}.tmp"
+        with self.lock:
+            if not self.changed or not force and time.monotonic() - self.saved_at < INDEX_SAVE_INTERVAL:
+                return
+            with open(temporary_path, "w", encoding="utf-8") as index_file:
+                json.dump(self.entries, index_file, ensure_ascii=False)
+            os.replace(temporary_path, self.path)
+            self.changed = False
+            self.saved_at = time.monotonic()
+
+def suggest(folder:str, agents:dict, index:RenameIndex, reviewable:queue.Queue) -> None:
+    """
+    Scans `folder` and has the models suggest names batch by batch in the
+    background, queueing each file for review as soon as its batch is back.
+    A None in the queue means there is nothing more to come.
+    """
+
+    def suggest_batch(unseen):
+        send_list(unseen, agents)
+        for file in unseen:
+            if settled(file["name"], file["suggestions"]):
+                index.record(file)
+            if file["new_names"]:
+                reviewable.put(file)
+        index.save()
 
-    current_file = files.pop(0)
-    if not current_file["new_names"]:
-        return iterate(files)
-    first_suggestion = new_full_name(current_file)
-    return current_file, first_suggestion
+    try:
+        with ThreadPoolExecutor(BATCH_WORKERS) as executor:
+            in_flight = set()
+            for batch in batched(scan(folder), SCAN_BATCH, sorting_key):
+                unseen = []
+                for file in batch:
+                    entry = index.lookup(file)
+                    if entry is None:
+                        unseen.append(file)
+                    elif entry["decision"] is None and entry["suggestions"]: # suggested last time, but never reviewed
+                        file["suggestions"] = entry["suggestions"]
+                        file["new_names"] = distinct_names(file)
+                        if file["new_names"]:
+                            reviewable.put(file)
+
+                if unseen:
+                    in_flight.add(executor.submit(suggest_batch, unseen))
+                if len(in_flight) >= BATCH_WORKERS: # don't scan much further ahead than the models
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+
+            for future in in_flight:
+                future.result()
+
+    except Exception as e:
+        print(f"Suggestions stopped: {e!r}")
 
-def main() -> None:
+    finally:
+        index.save(force=True)
+        reviewable.put(None)
+
+def show(window:sg.Window, file:dict) -> str:
+    for model in SOURCES:
+        suggestion = file["new_names"].get(model, "")
+        visible = bool(suggestion)
+        window[f"-ADOPT-{model}"].update(visible=visible)
+        window[model].update(suggestion, visible=visible)
+
+    duplicates = undecided_duplicates(file)
+    window["-GROUP-"].update(text=group_label(duplicates), value=bool(duplicates), visible=bool(duplicates))
+
+    new_name = new_full_name(file)
+    window["-NAME-"].update(relative_path(file))
+    window["-NEW_NAME-"].update(new_name)
+    return new_name
+
+def plan(folder:str, agents:dict, plan_path:str) -> None:
+    """
+    Headless: writes one JSON line per file that got suggestions, with every
+    model's suggestion and their agreement. When all MODELS agree, the
+    proposal is accepted; the rest is left in the index for review in the GUI.
+    """
+
+    index = RenameIndex(folder)
+    accepted = proposed = 0
+    with open(plan_path, "w", encoding="utf-8") as plan_file:
+        for batch in batched(scan(folder), SCAN_BATCH, sorting_key):
+            unseen, pending = [], []
+            for file in batch:
+                entry = index.lookup(file)
+                if entry is None:
+                    unseen.append(file)
+                elif entry["decision"] is None and entry["suggestions"]:
+                    file["suggestions"] = entry["suggestions"]
+                    pending.append(file)
+
+            if unseen:
+                send_list(unseen, agents)
+                for file in unseen:
+                    if settled(file["name"], file["suggestions"]):
+                        index.record(file)
+                index.save()
+
+            for file in pending + unseen:
+                if not file["suggestions"]:
+                    continue
+                score, consensus = agreement(file)
+                new_name = new_full_name(file, consensus) if score == 1 and consensus != file["name"] else None
+                proposal = {"folder": os.path.abspath(folder), "path": relative_path(file),
+                            "suggestions": file["suggestions"], "agreement": score,
+                            "accepted": new_name is not None, "new_name": new_name}
+                plan_file.write(json.dumps(proposal, ensure_ascii=False) + "\n")
+                plan_file.flush()
+                proposed += 1
+                accepted += new_name is not None
+
+    index.save(force=True)
+    print(f"{proposed} proposals written to {plan_path}, {accepted} accepted by consensus")
+
+def apply_plan(plan_path:str, undo_path:str) -> None:
+    """
+    Renames every accepted proposal in the plan, unless its new name is
+    taken (on disk or by another proposal); each rename is logged for `undo`.
+    Proposals whose file is gone were applied already, so a plan can be
+    applied again after an interruption.
+    """
+
+    with open(plan_path, encoding="utf-8") as plan_file:
+        proposals = [json.loads(line) for line in plan_file if line.strip()]
+    proposals = [proposal for proposal in proposals if proposal["accepted"]]
+
+    targets = {}
+    for proposal in proposals:
+        target = os.path.join(proposal["folder"], os.path.dirname(proposal["path"]), proposal["new_name"])
+        targets.setdefault(os.path.normcase(target), []).append(proposal)
+
+    indexes = {}
+    renamed = collided = applied = 0
+    with open(undo_path, "a", encoding="utf-8") as undo_file:
+        for proposal in proposals:
+            original_path = os.path.join(proposal["folder"], proposal["path"])
+            renamed_path  = os.path.join(proposal["folder"], os.path.dirname(proposal["path"]), proposal["new_name"])
+            if not os.path.exists(original_path): # renamed by an earlier run of the same plan, most likely
+                if os.path.exists(renamed_path):
+                    applied += 1
+                else:
+                    print(f"Can't find {original_path}")
+                continue
+            taken = os.path.exists(renamed_path) and not os.path.samefile(original_path, renamed_path) # case-only renames
+            if len(targets[os.path.normcase(renamed_path)]) > 1 or taken:
+                print(f"Collision, not renaming:\n    {original_path}\n  > {renamed_path}\n")
+                collided += 1
+                continue
+
+            try:
+                os.rename(original_path, renamed_path)
+            except OSError as e:
+                print(f"Can't rename {original_path}: {e}")
+                continue
+            undo_file.write(json.dumps({"from": original_path, "to": renamed_path}, ensure_ascii=False) + "\n")
+            undo_file.flush()
+            renamed += 1
+
+            index = indexes.setdefault(proposal["folder"], RenameIndex(proposal["folder"]))
+            stat = os.stat(renamed_path)
+            file = {"dir": os.path.dirname(proposal["path"]),
+                    "name": os.path.splitext(os.path.basename(proposal["path"]))[0],
+                    "ext": os.path.splitext(proposal["path"])[1],
+                    "size": stat.st_size, "mtime": stat.st_mtime, "suggestions": proposal["suggestions"]}
+            index.record(file, "renamed", proposal["new_name"])
+
+    for index in indexes.values():
+        index.save(force=True)
+    print(f"{renamed} files renamed, {applied} already renamed, {collided} collisions left alone; undo log: {undo_path}")
+
+def undo(undo_path:str) -> None:
+    with open(undo_path, encoding="utf-8") as undo_file:
+        renames = [json.loads(line) for line in undo_file if line.strip()]
+
+    for rename in reversed(renames):
+        if os.path.exists(rename["to"]) and not os.path.exists(rename["from"]):
+            os.rename(rename["to"], rename["from"])
+        else:
+            print(f"Can't undo {rename['from']} > {rename['to']}")
+
+def save_batch_state(state:dict, state_path:str) -> None:
+    temporary_path = f"{state_path}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as state_file:
+        json.dump(state, state_file, ensure_ascii=False)
+    os.replace(temporary_path, state_path)
+
+def prepare_batch(folder:str) -> dict:
+    """
+    The folder's files not in its index yet, with the names neither the local
+    parser nor a duplicate can settle numbered into clusters for the models.
+    """
+
+    index = RenameIndex(folder)
+    files = [file for file in scan(folder) if index.lookup(file) is None]
+    groups = [sorted(group, key=lambda file: len(file["name"])) for group in group_duplicates(files)] # the least cluttered first
+    positions = {id(file): n for n, file in enumerate(files)}
+    ambiguous = resolve_locally([group[0] for group in groups])
+    numbered_names = [f"{positions[id(file)]}:{file['name']}" for file in ambiguous]
+    batcher, clusters, start = Batcher(BATCH_CLUSTER_TOKENS), [], 0
+    while start < len(numbered_names):
+        clusters.append(batcher.next_cluster(numbered_names, start))
+        start += len(clusters[-1])
+
+    for file in files:
+        del file["group"] # the groups are kept as positions instead
+    return {"folder": os.path.abspath(folder), "files": files,
+            "groups": [[positions[id(file)] for file in group] for group in groups],
+            "clusters": clusters, "jobs": {}, "replies": {}} # jobs: {model: running batch}
+
+def merge_batch(state:dict) -> list[int]:
+    """
+    Records in the folder's index the files whose clusters every model
+    replied to; returns the clusters some model hasn't replied to yet.
+    """
+
+    files = state["files"]
+    unanswered, flawed = [], 0
+    for c, cluster in enumerate(state["clusters"]):
+        expected = {int(name.split(":", 1)[0]): name for name in cluster}
+        for model in MODELS:
+            reply = state["replies"][model].get(str(c))
+            if reply is None:
+                continue
+            answers, report = parse_reply(reply, expected)
+            flawed += not report["well_formed"]
+            for n, answer in answers.items():
+                if suggestion := clean_suggestion(answer):
+                    files[n]["suggestions"][model] = suggestion
+        if any(str(c) not in state["replies"][model] for model in MODELS):
+            unanswered.append(c)
+
+    pending = {int(name.split(":", 1)[0]) for c in unanswered for name in state["clusters"][c]}
+    index = RenameIndex(state["folder"])
+    recorded = 0
+    for group in state["groups"]:
+        if group[0] in pending: # left out until its cluster is resubmitted
+            continue
+        for n in group:
+            files[n]["suggestions"] = dict(files[group[0]]["suggestions"])
+            files[n]["new_names"] = distinct_names(files[n])
+            if settled(files[n]["name"], files[n]["suggestions"]):
+                index.record(files[n])
+                recorded += 1
+    index.save(force=True)
+    print(f"{recorded} of {len(files)} files recorded in the index; {len(state['clusters'])} clusters, "
+          f"{len(unanswered)} still missing a reply, {flawed} flawed replies")
+    return unanswered
+
+def batch(folder:str, agents:dict, state_path:str, poll_interval:float=BATCH_POLL_INTERVAL) -> None:
+    """
+    Headless and offline: has the models suggest names through their
+    providers' batch API, at a discount but within a day rather than at once.
+    The jobs are kept in `state_path`, so that running again after an
+    interruption picks them up, and resubmits whatever clusters a model
+    failed on. The suggestions end up in the index, ready for review in
+    the GUI or for a plan.
+    """
+
+    try:
+        with open(state_path, encoding="utf-8") as state_file:
+            state = json.load(state_file)
+        if state["folder"] != os.path.abspath(folder):
+            sys.exit(f"{state_path} holds the batch jobs of {state['folder']}: finish them, or pick another --state")
+        print(f"Resuming the batch jobs in {state_path}")
+    except FileNotFoundError:
+        state = prepare_batch(folder)
+        if not state["files"]:
+            return print(f"Nothing new in {folder}")
+        save_batch_state(state, state_path)
+        print(f"{len(state['files'])} new files, {sum(map(len, state['clusters']))} names for the models "
+              f"in {len(state['clusters'])} clusters")
+
+    finished = set() # models whose job ended during this run: they aren't resubmitted before the next one
+    while True:
+        running = []
+        for n, model in enumerate(MODELS):
+            replies = state["replies"].setdefault(model, {})
+            unanswered = [c for c in range(len(state["clusters"])) if str(c) not in replies]
+            if model in finished or (model not in state["jobs"] and not unanswered):
+                continue
+            try:
+                if model not in state["jobs"]:
+                    input_path = f"{state_path}.{n}.jsonl"
+                    with open(input_path, "w", encoding="utf-8") as input_file:
+                        for c in unanswered:
+                            line = agents[model].batch_line(str(c), "\n".join(state["clusters"][c]))
+                            input_file.write(json.dumps(line, ensure_ascii=False) + "\n")
+                    state["jobs"][model] = agents[model].submit_batch(input_path)
+                    save_batch_state(state, state_path)
+                    os.remove(input_path)
+                    print(f"{model}: {len(unanswered)} clusters submitted")
+
+                status = agents[model].batch_status(state["jobs"][model])
+                if status.status in opr.BATCH_FINAL_STATUSES:
+                    results = agents[model].batch_results(status)
+                    replies.update({c: reply for c, reply in results.items() if isinstance(reply, str)})
+                    del state["jobs"][model]
+                    finished.add(model)
+                    save_batch_state(state, state_path)
+                    print(f"{model}: batch {status.status}, {len(replies)}/{len(state['clusters'])} clusters replied to")
+                else:
+                    running.append(f"{model} ({status.status})")
+            except opr.GptConnectionError as e:
+                print(f"{model}: {e}; trying again later")
+                running.append(model)
+
+        if not running:
+            break
+        print(f"Still running: {', '.join(running)}. Checking again in {poll_interval:g} s "
+              f"(safe to interrupt: run again to resume)")
+        time.sleep(poll_interval)
+
+    if merge_batch(state):
+        save_batch_state(state, state_path)
+        print(f"Run again to resubmit the clusters that got no reply; they're kept in {state_path}")
+    else:
+        os.remove(state_path)
+
+def create_agents() -> tuple[dict, opr.ResponseCache]:
     agents = {}
     agent_creation_threads = {}
+    cache = opr.ResponseCache() # already seen clusters cost nothing on re-runs
     for model in MODELS:
-        agent_creation_threads[model] = threading.Thread(target=create_agent, args=(model, agents,))
+        agent_creation_threads[model] = threading.Thread(target=create_agent, args=(model, agents, cache))
         agent_creation_threads[model].start()
 
+    for model in MODELS:
+        agent_creation_threads[model].join()
+    return agents, cache
+
+def read_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Rename books with suggestions from several LLMs. "
+                                                 "Without a command, review them in a window.")
+    commands = parser.add_subparsers(dest="command")
+    plan_parser = commands.add_parser("plan", help="suggest names for a folder without a GUI, into a JSONL plan")
+    plan_parser.add_argument("folder")
+    plan_parser.add_argument("-o", "--output", default="rename-plan.jsonl")
+    apply_parser = commands.add_parser("apply", help="carry out the accepted renames of a plan")
+    apply_parser.add_argument("plan")
+    apply_parser.add_argument("--undo-log", default="rename-undo.jsonl")
+    undo_parser = commands.add_parser("undo", help="revert the renames in an undo log")
+    undo_parser.add_argument("undo_log")
+    batch_parser = commands.add_parser("batch", help="suggest names for a folder through the batch API, "
+                                                     "cheaper but within a day, into its index")
+    batch_parser.add_argument("folder")
+    batch_parser.add_argument("--state", default="book-renamer-batch.json", help="where the jobs are kept between runs")
+    batch_parser.add_argument("--poll", type=float, default=BATCH_POLL_INTERVAL, help="seconds between checks on the jobs")
+    return parser.parse_args()
+
+def next_to_review(reviewable:queue.Queue, block:bool=False) -> dict | None:
+    """
+    The next file in `reviewable` that wasn't decided along with its group;
+    raises queue.Empty if there's none yet, and returns None at the end.
+    """
+
+    while True:
+        file = reviewable.get(block=block)
+        if file is None or not file.get("decided"):
+            return file
+
+def undecided_duplicates(file:dict) -> list:
+    return [other for other in file.get("group", []) if other is not file and not other.get("decided")]
+
+def group_label(duplicates:list) -> str:
+    return f"also for its {len(duplicates)} duplicate(s): " + ", ".join(other["ext"] or other["name"] for other in duplicates)
+
+def main() -> None:
+    args = read_args()
+    if args.command == "apply":
+        return apply_plan(args.plan, args.undo_log)
+    if args.command == "undo":
+        return undo(args.undo_log)
+
+    agents, cache = create_agents()
+    if args.command == "plan":
+        plan(args.folder, agents, args.output)
+        print(f"cache: {cache.stats()}")
+        print_metrics()
+        return
+    if args.command == "batch":
+        return batch(args.folder, agents, args.state, args.poll)
+
     if True:
         folder = sg.popup_get_folder('Choose a folder')
-        # files = [
-        #     {"name": Path(filename).stem, "ext": Path(filename).suffix}
-        #     for path, _, filenames in os.walk(folder)
-        #     for filename in filenames
-        # ]
-        files = [{"name": os.path.splitext(filename)[0],
-                  "ext":  os.path.splitext(filename)[1],
-                  "new_names": {}}
-                for __, ___, filenames in os.walk(folder)
-                for filename in filenames]
+        index = RenameIndex(folder)
 
-        for model in MODELS:
-            agent_creation_threads[model].join()
+        reviewable = queue.Queue()
+        threading.Thread(target=suggest, args=(folder, agents, index, reviewable), daemon=True).start()
 
-        send_list(files, agents)
-        current_file, new_name = iterate(files)
+        current_file = next_to_review(reviewable, block=True) # the window opens with the first suggestions
         if current_file is None:
             print("nothing to do here!")
             sys.exit()
+        new_name = new_full_name(current_file)
 
         llm_entries = [
             [sg.Button(k=f"-ADOPT-{model}", button_text=f"{model.split('/', 1)[-1]}", visible=(model in current_file["new_names"])),
@@ -123,16 +917,19 @@ def main() -> None:
                           expand_x=True, expand_y=True, enable_events=True,
                       #   visible=bool(current_file.get(model)))]
                           visible=(model in current_file["new_names"]))]
-            for model in MODELS
+            for model in SOURCES
         ]
 
         layout = [
-            [sg.Text(key="-NAME-",   text=current_file["name"], expand_x=True, expand_y=True)]
+            [sg.Text(key="-NAME-",   text=relative_path(current_file), expand_x=True, expand_y=True)]
         ] + llm_entries + [
             [sg.Text(key="-NEW_NAME-", text=new_name, expand_x=True, expand_y=True)],
             [sg.Button(k="-RENAME-", button_text="Rename"), sg.Button(k="-SKIP-", button_text="Skip"),
              sg.Checkbox(k="-ARTICLE-",   text='article',   default=False, enable_events=True),
-             sg.Checkbox(k="-ANTHOLOGY-", text='anthology', default=False, enable_events=True)
+             sg.Checkbox(k="-ANTHOLOGY-", text='anthology', default=False, enable_events=True),
+             sg.Checkbox(k="-GROUP-", text=group_label(undecided_duplicates(current_file)),
+                         default=bool(undecided_duplicates(current_file)),
+                         visible=bool(undecided_duplicates(current_file)))
             ]
         ]
 
@@ -140,19 +937,23 @@ def main() -> None:
 
     try:
         while True:
-            # nobody made any suggestions # TODO tidy up this loop
-            if len(current_file["new_names"]) == 0:
-                event = "-SKIP-"
-                values = None
-                window.read()
-
-            else:
-                event, values = window.read()
+            event, values = window.read(timeout=POLL_INTERVAL)
 
             if event == sg.WIN_CLOSED:
                 break
 
-            edited_field = event in MODELS
+            if current_file is None: # reviewed everything so far; waiting on the models
+                try:
+                    current_file = next_to_review(reviewable)
+                except queue.Empty:
+                    continue
+                if current_file is None:
+                    print("bye bye!")
+                    break
+                new_name = show(window, current_file)
+                continue
+
+            edited_field = event in SOURCES
             chose_model = str(event).startswith("-ADOPT-")
             changed_checkbox = event in ["-ARTICLE-", "-ANTHOLOGY-"]
 
@@ -168,32 +969,55 @@ def main() -> None:
 
                 window["-NEW_NAME-"].update(new_name)
 
-            if event == "-RENAME-":
-                # original_path = Path(folder) / f"{current_file['name']}{current_file['ext']}"
-                # renamed_path = Path(folder) / new_name
-                original_path = os.path.join(folder, current_file["name"] + current_file["ext"])
-                renamed_path  = os.path.join(folder, new_name)
+            decided = [current_file] + (undecided_duplicates(current_file) if values["-GROUP-"] else [])
 
-                print(f"Renaming:\n    {original_path}\n  > {renamed_path}\n")
-                os.rename(original_path, renamed_path)
+            if event == "-RENAME-":
+                stem = new_name[:len(new_name) - len(current_file["ext"])]
+                for file in decided: # duplicates keep their own extension
+                    file_name = new_name if file is current_file else stem + file["ext"]
+                    original_path = os.path.join(folder, relative_path(file))
+                    renamed_path  = os.path.join(folder, relative_path(file, file_name))
+                    if file is not current_file and os.path.exists(renamed_path) \
+                            and not os.path.samefile(original_path, renamed_path):
+                        print(f"Not renaming {original_path}: {renamed_path} already exists\n")
+                        continue
+
+                    print(f"Renaming:\n    {original_path}\n  > {renamed_path}\n")
+                    os.rename(original_path, renamed_path)
+                    index.record(file, "renamed", file_name)
+                    file["decided"] = True
+                index.save()
+
+            if event == "-SKIP-":
+                for file in decided:
+                    index.record(file, "skipped")
+                    file["decided"] = True
+                index.save()
 
             if event in ["-SKIP-", "-RENAME-"]:
-                current_file, new_name = iterate(files)
+                try:
+                    current_file = next_to_review(reviewable)
+                except queue.Empty:
+                    current_file = None
+                    for model in SOURCES:
+                        window[f"-ADOPT-{model}"].update(visible=False)
+                        window[model].update("", visible=False)
+                    window["-GROUP-"].update(visible=False)
+                    window["-NAME-"].update("waiting for suggestions…")
+                    window["-NEW_NAME-"].update("")
+                    continue
+
                 if current_file is None:
                     print("bye bye!")
                     break
 
-                for model in MODELS:
-                    suggestion = current_file["new_names"].get(model, "")
-                    visible = bool(suggestion)
-                    window[f"-ADOPT-{model}"].update(visible=visible)
-                    window[model].update(suggestion, visible=visible)
-
-                window["-NAME-"].update(current_file["name"])
-                window["-NEW_NAME-"].update(new_name)
+                new_name = show(window, current_file)
 
     finally:
         window.close()
+        index.save(force=True)
+        print(f"cache: {cache.stats()}")
+        print_metrics()
 
 if __name__ == "__main__":
     main()
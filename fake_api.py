@@ -0,0 +1,336 @@
+import argparse
+import email.parser
+import email.policy
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+LOREM = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+         "incididunt ut labore et dolore magna aliqua").split()
+
+
+def echo_reply(messages:list[dict]) -> str:
+    return messages[-1]["content"]
+
+def lorem_reply(words:int=100):
+    """
+    Replies of `words` words whatever the question, e.g. to time long streams.
+    """
+
+    text = " ".join(LOREM[n % len(LOREM)] for n in range(words))
+    return lambda messages: text
+
+def rename_reply(drop_rate:float=0, seed:int=None):
+    """
+    Answers book-renamer's "N:name" lines in kind, title-cased, leaving out
+    about `drop_rate` of them like a sloppy model would.
+    """
+
+    rng = random.Random(seed)
+
+    def reply(messages):
+        lines = [line for line in messages[-1]["content"].split("\n") if ":" in line]
+        return "\n".join(line.title() for line in lines if rng.random() >= drop_rate)
+    return reply
+
+REPLIES = {"echo": lambda args: echo_reply,
+           "lorem": lambda args: lorem_reply(args.reply_words),
+           "rename": lambda args: rename_reply(args.drop_rate, args.seed)}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "FakeChat/0.1"
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True # or headers and body, written apart, wait on a delayed ACK
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, status:int, payload:dict, headers:dict=None) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_not_found(self) -> None:
+        self.send_json(404, {"error": {"message": f"no route for {self.path}"}})
+
+    def do_GET(self) -> None:
+        fake = self.server.fake
+        parts = self.path.rstrip("/").split("/")
+        if len(parts) >= 2 and parts[-2] == "batches" and parts[-1] in fake.batches:
+            self.send_json(200, fake.batch(parts[-1]))
+        elif len(parts) >= 3 and parts[-3] == "files" and parts[-1] == "content" and parts[-2] in fake.files:
+            body = fake.files[parts[-2]]["content"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_not_found()
+
+    def upload_file(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        head = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode()
+        form = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(head + self.rfile.read(length))
+        fields = {part.get_param("name", header="content-disposition"): part for part in form.iter_parts()}
+        file = fields["file"]
+        self.send_json(200, self.server.fake.add_file(file.get_payload(decode=True), file.get_filename() or "upload",
+                                                      fields["purpose"].get_content().strip()))
+
+    def do_POST(self) -> None:
+        if self.path.endswith("/files"):
+            self.upload_file()
+            return
+        if self.path.endswith("/batches"):
+            self.send_json(200, self.server.fake.create_batch(self.read_json()))
+            return
+        if not self.path.endswith("/chat/completions"):
+            self.send_not_found()
+            return
+
+        fake = self.server.fake
+        request = self.read_json()
+        time.sleep(fake.latency)
+
+        with fake.lock:
+            fake.requests += 1
+            roll = fake.random.random()
+            if roll < fake.rate_limit_rate + fake.error_rate:
+                fake.injected_errors += 1
+        if roll < fake.rate_limit_rate:
+            self.send_json(429, {"error": {"message": "Rate limit reached (fake)", "type": "rate_limit_exceeded"}},
+                           {"retry-after-ms": str(int(fake.retry_after * 1000))})
+            return
+        if roll < fake.rate_limit_rate + fake.error_rate:
+            self.send_json(500, {"error": {"message": "Internal error (fake)", "type": "server_error"}})
+            return
+
+        reply = fake.reply(request["messages"])
+        if request.get("stream"):
+            self.stream_reply(request, reply)
+        else:
+            self.send_json(200, completion(request, reply))
+
+    def stream_reply(self, request:dict, reply:str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        interval = 1 / self.server.fake.tokens_per_second if self.server.fake.tokens_per_second else 0
+        for delta in split_words(reply):
+            time.sleep(interval) # counting a word as a token
+            self.wfile.write(f"data: {json.dumps(chunk(request, delta))}\n\n".encode())
+            self.wfile.flush()
+        self.wfile.write(f"data: {json.dumps(chunk(request, None, 'stop'))}\n\n".encode())
+        if request.get("stream_options", {}).get("include_usage"):
+            usage_chunk = dict(chunk(request, None), choices=[], usage=completion(request, reply)["usage"])
+            self.wfile.write(f"data: {json.dumps(usage_chunk)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128 # the default 5 drops the connections of a burst, costing them a 1 s SYN retry
+
+
+def split_words(text:str) -> list[str]:
+    """
+    Cuts a reply into word-sized deltas, keeping the whitespace,
+    roughly like a real model streams tokens.
+    """
+
+    deltas, start = [], 0
+    for n in range(1, len(text)):
+        if text[n].isspace() and not text[n - 1].isspace():
+            deltas.append(text[start:n])
+            start = n
+    deltas.append(text[start:])
+    return [delta for delta in deltas if delta]
+
+
+def completion(request:dict, reply:str) -> dict:
+    prompt_tokens = sum(len(m["content"]) for m in request["messages"]) // 4
+    completion_tokens = len(reply) // 4
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request["model"],
+        "choices": [{"index": 0,
+                     "message": {"role": "assistant", "content": reply},
+                     "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens,
+                  "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+def chunk(request:dict, delta:str, finish_reason:str=None) -> dict:
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": request["model"],
+        "choices": [{"index": 0,
+                     "delta": {"content": delta} if delta is not None else {},
+                     "finish_reason": finish_reason}],
+    }
+
+
+class FakeChatServer:
+    """
+    A local stand-in for an OpenAI-style chat-completions endpoint.
+    `reply` maps the request's messages to the assistant's answer, which
+    comes after `latency` seconds and streams at `tokens_per_second` (0 for
+    no limit). About `rate_limit_rate` of the requests get a 429 asking to
+    retry after `retry_after` seconds, and `error_rate` of them a 500.
+
+    It also stands in for the batch API (file uploads, batches and their
+    results): a batch completes once it's looked up `batch_delay` seconds
+    after its creation, with `error_rate` of its requests failed.
+
+        with FakeChatServer(latency=.2) as server:
+            Gpt(base_url=server.base_url, key="fake").query("hi")
+    """
+
+    def __init__(self, reply=None, latency:float=0, tokens_per_second:float=0, error_rate:float=0,
+                 rate_limit_rate:float=0, retry_after:float=.1, seed:int=None,
+                 host:str="127.0.0.1", port:int=0, batch_delay:float=0) -> None:
+        self.reply = reply or echo_reply
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.injected_errors = 0
+        self.batch_delay = batch_delay
+        self.files = {}
+        self.batches = {}
+        self.batch_lock = threading.Lock()
+
+        self.httpd = _Server((host, port), _Handler)
+        self.httpd.fake = self
+        self.httpd.handle_error = lambda request, client_address: None # clients hanging up on timeouts
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def add_file(self, content:bytes, filename:str, purpose:str) -> dict:
+        with self.lock:
+            file_id = f"file-fake{len(self.files)}"
+            self.files[file_id] = {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                                   "filename": filename, "purpose": purpose, "status": "processed", "content": content}
+        return {name: value for name, value in self.files[file_id].items() if name != "content"}
+
+    def create_batch(self, request:dict) -> dict:
+        with self.lock:
+            batch_id = f"batch_fake{len(self.batches)}"
+            self.batches[batch_id] = {"id": batch_id, "object": "batch", "endpoint": request["endpoint"],
+                                      "input_file_id": request["input_file_id"],
+                                      "completion_window": request["completion_window"],
+                                      "status": "in_progress", "created_at": int(time.time()),
+                                      "output_file_id": None, "error_file_id": None,
+                                      "metadata": request.get("metadata"),
+                                      "request_counts": {"total": 0, "completed": 0, "failed": 0},
+                                      "due": time.monotonic() + self.batch_delay}
+        return self.batch(batch_id)
+
+    def batch(self, batch_id:str) -> dict:
+        """
+        The batch, run through the first time it's looked up once due.
+        """
+
+        batch = self.batches[batch_id]
+        with self.batch_lock:
+            if batch["status"] == "in_progress" and time.monotonic() >= batch["due"]:
+                self.run_batch(batch)
+            return {name: value for name, value in batch.items() if name != "due"}
+
+    def run_batch(self, batch:dict) -> None:
+        outputs, errors = [], []
+        for line in self.files[batch["input_file_id"]]["content"].decode().splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            with self.lock:
+                self.requests += 1
+                failed = self.random.random() < self.error_rate
+            if failed:
+                response = {"status_code": 500, "request_id": "req-fake",
+                            "body": {"error": {"message": "Internal error (fake)", "type": "server_error"}}}
+                errors.append({"id": "batch_req_fake", "custom_id": request["custom_id"], "response": response,
+                               "error": None})
+            else:
+                body = completion(request["body"], self.reply(request["body"]["messages"]))
+                outputs.append({"id": "batch_req_fake", "custom_id": request["custom_id"],
+                                "response": {"status_code": 200, "request_id": "req-fake", "body": body},
+                                "error": None})
+
+        for results, field in ((outputs, "output_file_id"), (errors, "error_file_id")):
+            if results:
+                content = "".join(json.dumps(result) + "\n" for result in results).encode()
+                batch[field] = self.add_file(content, f"{batch['id']}_{field}.jsonl", "batch_output")["id"]
+        batch["request_counts"] = {"total": len(outputs) + len(errors), "completed": len(outputs),
+                                   "failed": len(errors)}
+        batch["status"] = "completed"
+
+    def start(self) -> "FakeChatServer":
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "FakeChatServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+def read_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Serve fake chat completions.")
+    parser.add_argument("--port", type=int, default=8808, help="0 for any free port")
+    parser.add_argument("--latency", type=float, default=0, help="seconds before each reply")
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="streaming rate, 0 for no limit")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of requests failing with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="share of requests getting a 429")
+    parser.add_argument("--retry-after", type=float, default=.1, help="seconds, as told to throttled clients")
+    parser.add_argument("--reply", choices=REPLIES, default="echo")
+    parser.add_argument("--reply-words", type=int, default=100, help="length of lorem replies")
+    parser.add_argument("--drop-rate", type=float, default=0, help="share of lines left out of rename replies")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--batch-delay", type=float, default=0, help="seconds before a batch completes")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = read_args()
+    server = FakeChatServer(REPLIES[args.reply](args), args.latency, args.tokens_per_second, args.error_rate,
+                            args.rate_limit_rate, args.retry_after, args.seed, port=args.port,
+                            batch_delay=args.batch_delay)
+    print(f"Serving fake chat completions on {server.base_url}", flush=True)
+    server.httpd.serve_forever()
@@ -1,9 +1,619 @@
+import asyncio
+import collections
+import contextlib
+import email.utils
+import hashlib
+import httpx
+import json
+import math
 import openai
+import os
+import queue
+import random
+import re
+import sqlite3
+import threading
 import time
+import warnings
+from types import SimpleNamespace
 
 DEFAULT_MODEL = "gpt-4o"
 DEFAULT_TEMP = 1
 DEFAULT_REQ_TIMEOUT = 10 #seconds
+DEFAULT_CONNECT_TIMEOUT = 5 #seconds
+DEFAULT_MAX_RETRIES = 4
+DEFAULT_CONCURRENCY = 8 # simultaneous requests in query_many
+DEFAULT_CONTEXT_BUDGET = 16000 # tokens of context (pinned messages + conversation) per query
+CONTEXT_TRIM_TARGET = .75 # when over budget, old exchanges go until the context is this full
+RETRY_BASE_DELAY = .5 #seconds, doubled on every attempt
+RETRY_MAX_DELAY = 30 #seconds
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_TIMEOUT = 300 #seconds, for uploading and downloading batch files
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+HEDGE_DEFAULT_DELAY = 2 #seconds without a first token before hedging, until there's enough to learn from
+HEDGE_MIN_SAMPLES = 10  # times to first token needed to learn the hedging delay from
+HEDGE_WINDOW = 100      # latest times to first token it's learned from
+HEDGE_PERCENTILE = .95  # so that about 5% of the streams are hedged
+CANCEL_POLL_INTERVAL = .05 #seconds between checks on a racing request still waiting for its headers
+POOL_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".gpt_lib_cache.sqlite")
+
+
+class GptError(Exception):
+    """ Base class of everything a Gpt query can raise. """
+
+class GptConnectionError(GptError):
+    pass
+
+class GptTimeoutError(GptConnectionError):
+    pass
+
+class GptStatusError(GptError):
+    def __init__(self, message:str, status_code:int) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+class GptRateLimitError(GptStatusError):
+    pass
+
+class GptCancelledError(GptError):
+    """ Raised by a stream that lost a race. """
+
+
+def typed_error(error:openai.OpenAIError) -> GptError:
+    if isinstance(error, openai.APITimeoutError):
+        return GptTimeoutError(str(error))
+    if isinstance(error, openai.APIConnectionError):
+        return GptConnectionError(str(error))
+    if isinstance(error, openai.RateLimitError):
+        return GptRateLimitError(str(error), error.status_code)
+    if isinstance(error, openai.APIStatusError):
+        return GptStatusError(str(error), error.status_code)
+    return GptError(str(error))
+
+def is_retryable(error:openai.OpenAIError) -> bool:
+    if isinstance(error, openai.APIConnectionError): # timeouts included
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in RETRY_STATUSES
+
+def retry_delay(attempt:int, error:openai.OpenAIError=None) -> float:
+    """
+    Honors the server's Retry-After when there is one;
+    otherwise backs off exponentially with full jitter.
+    """
+
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after_ms = response.headers.get("retry-after-ms")
+        retry_after = response.headers.get("retry-after")
+        for value, unit in ((retry_after_ms, .001), (retry_after, 1)):
+            try:
+                delay = float(value) * unit
+            except (TypeError, ValueError):
+                continue
+            if math.isfinite(delay) and delay >= 0: # not "-5" or "nan", which sleep() would choke on
+                return min(delay, RETRY_MAX_DELAY)
+        try: # an HTTP date, then
+            retry_date = email.utils.parsedate_to_datetime(retry_after)
+            return min(max(retry_date.timestamp() - time.time(), 0), RETRY_MAX_DELAY)
+        except (TypeError, ValueError): # missing or malformed: back off as if there were none
+            pass
+
+    return random.uniform(0, min(RETRY_BASE_DELAY * 2**attempt, RETRY_MAX_DELAY))
+
+
+def estimate_tokens(text:str) -> int:
+    return len(text) // 4 + 1 # ~4 characters per token in English prose
+
+def estimate_message_tokens(message:dict) -> int:
+    return estimate_tokens(message["content"]) + 4 # + role and separators
+
+def estimate_prompt_tokens(messages:list[dict]) -> int:
+    return sum(estimate_message_tokens(message) for message in messages)
+
+
+class RateLimiter:
+    """
+    Token buckets for requests and tokens per minute, refilled continuously.
+    Requests are charged their estimated token count up front; `reconcile`
+    settles the difference once the response's `usage` is known.
+    Callers wait their turn first come, first served.
+    """
+
+    def __init__(self, requests_per_minute:int=None, tokens_per_minute:int=None) -> None:
+        self.condition = threading.Condition()
+        self.next_ticket = 0 # handed to each caller on arrival
+        self.serving = 0     # the ticket allowed to take from the buckets
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.requests = float(requests_per_minute or 0) # full buckets to start with
+        self.tokens = float(tokens_per_minute or 0)
+        self.last_refill = time.monotonic()
+
+    def set_limits(self, requests_per_minute:int=None, tokens_per_minute:int=None) -> None:
+        """
+        Changes the capacities. What's left in a bucket is kept, up to its new
+        capacity, so that setting limits again never hands out a fresh allowance;
+        only a bucket that had no limit before starts full.
+        """
+
+        with self.condition:
+            if (requests_per_minute, tokens_per_minute) == (self.requests_per_minute, self.tokens_per_minute):
+                return
+            self.refill()
+            if requests_per_minute:
+                self.requests = min(self.requests, requests_per_minute) if self.requests_per_minute else float(requests_per_minute)
+            if tokens_per_minute:
+                self.tokens = min(self.tokens, tokens_per_minute) if self.tokens_per_minute else float(tokens_per_minute)
+            self.requests_per_minute = requests_per_minute
+            self.tokens_per_minute = tokens_per_minute
+            self.condition.notify_all()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        elapsed, self.last_refill = now - self.last_refill, now
+        if self.requests_per_minute:
+            self.requests = min(self.requests + elapsed * self.requests_per_minute / 60, self.requests_per_minute)
+        if self.tokens_per_minute:
+            self.tokens = min(self.tokens + elapsed * self.tokens_per_minute / 60, self.tokens_per_minute)
+
+    def wait_time(self, tokens:int) -> float:
+        wait = 0.0
+        if self.requests_per_minute and self.requests < 1:
+            wait = max(wait, (1 - self.requests) * 60 / self.requests_per_minute)
+        if self.tokens_per_minute and self.tokens < tokens:
+            wait = max(wait, (tokens - self.tokens) * 60 / self.tokens_per_minute)
+        return wait
+
+    def acquire(self, tokens:int=0) -> float:
+        """
+        Blocks until a request of `tokens` tokens fits; returns the seconds waited.
+        """
+
+        started = time.monotonic()
+        with self.condition:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            while True:
+                if ticket == self.serving:
+                    self.refill()
+                    fitting_tokens = min(tokens, self.tokens_per_minute or tokens) # never wait for the impossible
+                    wait = self.wait_time(fitting_tokens)
+                    if wait <= 0:
+                        if self.requests_per_minute:
+                            self.requests -= 1
+                        if self.tokens_per_minute:
+                            self.tokens -= fitting_tokens
+                        self.serving += 1
+                        self.condition.notify_all()
+                        return time.monotonic() - started
+                    self.condition.wait(wait)
+                else:
+                    self.condition.wait()
+
+    def reconcile(self, estimated_tokens:int, actual_tokens:int) -> None:
+        if not self.tokens_per_minute:
+            return
+        with self.condition:
+            self.tokens -= actual_tokens - estimated_tokens
+            self.condition.notify_all()
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def shared_rate_limiter(model:str, requests_per_minute:int=None, tokens_per_minute:int=None) -> RateLimiter:
+    """
+    The process-wide limiter for `model`; given limits replace its previous ones
+    without refilling it.
+    """
+
+    with _rate_limiters_lock:
+        if model not in _rate_limiters:
+            _rate_limiters[model] = RateLimiter(requests_per_minute, tokens_per_minute)
+        elif requests_per_minute or tokens_per_minute:
+            _rate_limiters[model].set_limits(requests_per_minute, tokens_per_minute)
+        return _rate_limiters[model]
+
+
+_shared_http_client = None
+_pool_lock = threading.Lock()
+
+def shared_http_client() -> httpx.Client:
+    """
+    The connection pool every Gpt in this process sends its requests through.
+    """
+
+    global _shared_http_client
+    with _pool_lock:
+        if _shared_http_client is None:
+            _shared_http_client = httpx.Client(limits=POOL_LIMITS)
+        return _shared_http_client
+
+def configure_pool(max_connections:int=None, max_keepalive_connections:int=None) -> None:
+    """
+    Resizes the shared connection pool; Gpt objects created afterwards use the new one.
+    """
+
+    global POOL_LIMITS, _shared_http_client
+    with _pool_lock:
+        POOL_LIMITS = httpx.Limits(max_connections=max_connections or POOL_LIMITS.max_connections,
+                                   max_keepalive_connections=max_keepalive_connections or POOL_LIMITS.max_keepalive_connections)
+        _shared_http_client = None
+
+
+class ResponseCache:
+    """
+    Opt-in on-disk store of completions, keyed on everything that shapes a
+    reply: model, temperature and the full list of messages (context included).
+    Entries older than `ttl` seconds are dropped, and beyond `max_entries`
+    the least recently used ones go first.
+    One instance can be shared by any number of Gpt objects and threads.
+    """
+
+    def __init__(self, path:str=None, max_entries:int=None, ttl:float=None) -> None:
+        self.path = path or DEFAULT_CACHE_PATH
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS replies (
+                               key       TEXT PRIMARY KEY,
+                               reply     TEXT NOT NULL,
+                               created   REAL NOT NULL,
+                               last_used REAL NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS replies_last_used ON replies (last_used)")
+        self.db.commit()
+
+    @staticmethod
+    def key(model:str, temperature:float, messages:list[dict]) -> str:
+        payload = json.dumps([model, temperature, messages], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key:str) -> str | None:
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT reply, created FROM replies WHERE key = ?", (key,)).fetchone()
+            if row and self.ttl is not None and now - row[1] > self.ttl:
+                self.db.execute("DELETE FROM replies WHERE key = ?", (key,))
+                self.db.commit()
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.db.execute("UPDATE replies SET last_used = ? WHERE key = ?", (now, key))
+            self.db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key:str, reply:str) -> None:
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO replies VALUES (?, ?, ?, ?)", (key, reply, now, now))
+            self.evict()
+            self.db.commit()
+
+    def discard(self, key:str) -> None:
+        with self.lock:
+            self.db.execute("DELETE FROM replies WHERE key = ?", (key,))
+            self.db.commit()
+
+    def evict(self) -> None:
+        """ Call with the lock held. """
+
+        if self.ttl is not None:
+            self.db.execute("DELETE FROM replies WHERE created < ?", (time.time() - self.ttl,))
+
+        if self.max_entries is not None:
+            self.db.execute("""DELETE FROM replies WHERE key IN (
+                                   SELECT key FROM replies ORDER BY last_used DESC LIMIT -1 OFFSET ?)""",
+                            (self.max_entries,))
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM replies").fetchone()[0]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self),
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+
+def replay_stream(reply:str):
+    """
+    Serves a cached reply as a synthetic stream, shaped like the
+    chunks of a streamed chat completion.
+    """
+
+    for delta in re.findall(r"\s*\S+", reply) or [reply]:
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=delta))])
+
+
+class Flight:
+    """
+    One upstream request, as seen by everyone waiting on it: the leader that
+    sends it relays its deltas and outcome, and every follower reads them
+    with a cursor of its own.
+    """
+
+    def __init__(self) -> None:
+        self.condition = threading.Condition()
+        self.deltas = []
+        self.done = False
+        self.reply = None
+        self.error = None
+        self.waiters = [] # (event loop, future) of the coroutines awaiting aresult()
+
+    def put(self, delta:str) -> None:
+        with self.condition:
+            self.deltas.append(delta)
+            self.condition.notify_all()
+
+    def finish(self, reply:str=None, error:BaseException=None) -> None:
+        with self.condition:
+            self.reply, self.error, self.done = reply, error, True
+            self.condition.notify_all()
+            waiters, self.waiters = self.waiters, []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(None))
+            except RuntimeError: # its loop is closed already
+                pass
+
+    def relay(self, response):
+        """
+        Passes a streamed response's chunks through, putting their deltas.
+        """
+
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                self.put(chunk.choices[0].delta.content)
+            yield chunk
+
+    def result(self) -> str:
+        with self.condition:
+            self.condition.wait_for(lambda: self.done)
+        if self.error is not None:
+            raise self.error
+        return self.reply
+
+    async def aresult(self) -> str:
+        """
+        result() for coroutines, awaited without holding an executor thread
+        (which the leader may need for its rate limiter).
+        """
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.condition:
+            if not self.done:
+                self.waiters.append((loop, future))
+            else:
+                future.set_result(None)
+        await future
+        if self.error is not None:
+            raise self.error
+        return self.reply
+
+    def chunks(self):
+        """
+        The deltas so far and to come, shaped like a stream's chunks
+        (the whole reply in one, if the leader didn't stream).
+        """
+
+        position = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: position < len(self.deltas) or self.done)
+                deltas, done = self.deltas[position:], self.done
+            position += len(deltas)
+            if done and position == 0 and self.reply:
+                deltas = [self.reply]
+            for delta in deltas:
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=delta))])
+            if done:
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+def flight_key(base_url:str, model:str, temperature:float, messages:list[dict]) -> str:
+    return ResponseCache.key(f"{base_url}|{model}", temperature, messages)
+
+def join_flight(key:str, lead:bool=True) -> tuple[Flight | None, bool]:
+    """
+    The process-wide flight for `key` and whether the caller leads it,
+    i.e. must send the request, then `finish` the flight and `land_flight` it.
+    With `lead` False, there's no flight unless someone else leads one.
+    """
+
+    with _flights_lock:
+        if key in _flights:
+            return _flights[key], False
+        if not lead:
+            return None, False
+        _flights[key] = Flight()
+        return _flights[key], True
+
+def land_flight(key:str) -> None:
+    with _flights_lock:
+        _flights.pop(key, None)
+
+
+SAMPLED_METRICS = ("queue_wait", "ttft", "latency", "tokens_per_second")
+QUANTILES = (.5, .9, .99)
+
+
+def new_record(model:str, stream:bool) -> dict:
+    """
+    The measurements of one request, as handed to the metrics sinks. Times are
+    in seconds from the call; `queue_wait` is the time spent waiting for the
+    rate limiter (and, in query_many, for a free slot), `ttft` the time to
+    the first streamed token (to the whole reply when not streaming), and
+    `tokens_per_second` the output rate once the reply started coming.
+    A `shared` request rode along an identical one already in flight.
+    """
+
+    return {"model": model, "stream": stream, "started": time.time(), "_clock": time.perf_counter(),
+            "queue_wait": 0.0, "ttft": None, "latency": None, "tokens_per_second": None,
+            "prompt_tokens": None, "completion_tokens": None, "retries": 0, "cached": False, "shared": False,
+            "error": None}
+
+def percentile(sorted_values:list[float], fraction:float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class MetricsStats:
+    """
+    In-memory metrics sink: running totals per model, and percentiles over
+    its `window` latest (answered, uncached) requests.
+
+        stats = MetricsStats()
+        gpt = Gpt(metrics=[stats])
+        ...
+        print(stats.summary())
+    """
+
+    def __init__(self, window:int=1000) -> None:
+        self.window = window
+        self.lock = threading.Lock()
+        self.models = {}
+
+    def model_totals(self, model:str) -> dict:
+        """ Call with the lock held. """
+
+        if model not in self.models:
+            self.models[model] = {"requests": 0, "cached": 0, "shared": 0, "retries": 0, "errors": {},
+                                  "prompt_tokens": 0, "completion_tokens": 0,
+                                  "sums": dict.fromkeys(SAMPLED_METRICS, 0.0),
+                                  "counts": dict.fromkeys(SAMPLED_METRICS, 0),
+                                  "samples": {name: collections.deque(maxlen=self.window)
+                                              for name in SAMPLED_METRICS}}
+        return self.models[model]
+
+    def __call__(self, record:dict) -> None:
+        with self.lock:
+            totals = self.model_totals(record["model"])
+            totals["requests"] += 1
+            totals["shared"] += record["shared"]
+            totals["retries"] += record["retries"]
+            totals["prompt_tokens"] += record["prompt_tokens"] or 0
+            totals["completion_tokens"] += record["completion_tokens"] or 0
+            if record["cached"]:
+                totals["cached"] += 1
+                return
+            if record["error"]:
+                totals["errors"][record["error"]] = totals["errors"].get(record["error"], 0) + 1
+                return
+            for name in SAMPLED_METRICS:
+                if record[name] is not None:
+                    totals["samples"][name].append(record[name])
+                    totals["sums"][name] += record[name]
+                    totals["counts"][name] += 1
+
+    def summary(self) -> dict:
+        """
+        Per model: the totals, and p50/p90/p99 of every sampled metric.
+        """
+
+        with self.lock:
+            summary = {}
+            for model, totals in self.models.items():
+                summary[model] = {"requests": totals["requests"], "cached": totals["cached"],
+                                  "shared": totals["shared"], "retries": totals["retries"],
+                                  "errors": dict(totals["errors"]),
+                                  "prompt_tokens": totals["prompt_tokens"],
+                                  "completion_tokens": totals["completion_tokens"]}
+                for name in SAMPLED_METRICS:
+                    values = sorted(totals["samples"][name])
+                    summary[model][name] = {f"p{round(q * 100)}": percentile(values, q)
+                                            for q in QUANTILES} if values else None
+            return summary
+
+
+class PrometheusSink(MetricsStats):
+    """
+    MetricsStats that also renders itself in the Prometheus text exposition
+    format, for a scrape handler or node_exporter's textfile collector.
+    """
+
+    def exposition(self) -> str:
+        lines = []
+
+        def family(name, kind, help):
+            lines.extend([f"# HELP {name} {help}", f"# TYPE {name} {kind}"])
+
+        with self.lock:
+            models = sorted(self.models.items())
+
+            for name, key, help in (("gpt_requests_total", "requests", "Chat completion requests."),
+                                    ("gpt_cache_hits_total", "cached", "Requests answered from the cache."),
+                                    ("gpt_shared_total", "shared", "Requests sharing an identical one in flight."),
+                                    ("gpt_retries_total", "retries", "Retried attempts."),
+                                    ("gpt_prompt_tokens_total", "prompt_tokens", "Prompt tokens, as reported."),
+                                    ("gpt_completion_tokens_total", "completion_tokens", "Completion tokens, as reported.")):
+                family(name, "counter", help)
+                lines.extend(f'{name}{{model="{model}"}} {totals[key]}' for model, totals in models)
+
+            family("gpt_errors_total", "counter", "Failed requests, by error type.")
+            for model, totals in models:
+                lines.extend(f'gpt_errors_total{{model="{model}",error="{error}"}} {count}'
+                             for error, count in sorted(totals["errors"].items()))
+
+            for metric, name, help in (("queue_wait", "gpt_queue_wait_seconds", "Time waiting to be sent."),
+                                       ("ttft", "gpt_time_to_first_token_seconds", "Time to the first token."),
+                                       ("latency", "gpt_request_latency_seconds", "Time to the whole reply."),
+                                       ("tokens_per_second", "gpt_output_tokens_per_second", "Output token rate.")):
+                family(name, "summary", help)
+                for model, totals in models:
+                    values = sorted(totals["samples"][metric])
+                    if values:
+                        lines.extend(f'{name}{{model="{model}",quantile="{q}"}} {percentile(values, q)}'
+                                     for q in QUANTILES)
+                    lines.append(f'{name}_sum{{model="{model}"}} {totals["sums"][metric]}')
+                    lines.append(f'{name}_count{{model="{model}"}} {totals["counts"][metric]}')
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path:str) -> None:
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as file:
+            file.write(self.exposition())
+        os.replace(temp_path, path) # scrapers never see half a file
+
+
+class JsonlSink:
+    """
+    Metrics sink appending every record to `path` as one JSON line.
+    """
+
+    def __init__(self, path:str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def __call__(self, record:dict) -> None:
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
+
 
 class Gpt:
     def __init__(self,
@@ -14,28 +624,74 @@ class Gpt:
                  temperature:float=None,
                  query_timeout:int=None,
                  base_url:str=None,
-                 key:str=None) -> None:
-
-        self.client = openai.OpenAI(api_key=key, base_url=base_url) #TODO timeout
+                 key:str=None,
+                 cache:ResponseCache=None,
+                 max_retries:int=None,
+                 requests_per_minute:int=None,
+                 tokens_per_minute:int=None,
+                 rate_limiter:RateLimiter=None,
+                 conversational:bool=False,
+                 context_budget:int=None,
+                 metrics:list=None,
+                 tracer=None,
+                 hedge:"Gpt"=None,
+                 single_flight:bool=True) -> None:
 
         self.model = model or DEFAULT_MODEL
         self.temperature = temperature or DEFAULT_TEMP
         self.query_timeout = query_timeout or DEFAULT_REQ_TIMEOUT
+        self.max_retries = max_retries if max_retries is not None else DEFAULT_MAX_RETRIES
+        self.cache = cache
+        self.single_flight = single_flight # identical requests in flight at once (in this process) share one call
+        if rate_limiter is None and (requests_per_minute or tokens_per_minute):
+            rate_limiter = shared_rate_limiter(self.model, requests_per_minute, tokens_per_minute)
+        self.rate_limiter = rate_limiter
+
+        # Every request's measurements (see new_record) go to each of the `metrics`
+        # sinks, and, given an OpenTelemetry-style `tracer`, into a span of their own.
+        self.metrics = list(metrics or [])
+        self.tracer = tracer
+
+        # Streams from a Gpt with a `hedge` (another model or endpoint) race it
+        # whenever their first token is later than usual; see `race`.
+        self.hedge = hedge
+        self.first_token_times = collections.deque(maxlen=HEDGE_WINDOW)
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self.streaming_response = None
+
+        self.key = key
+        self.base_url = base_url
+        self.timeout = httpx.Timeout(self.query_timeout, connect=min(DEFAULT_CONNECT_TIMEOUT, self.query_timeout))
+        self.client = openai.OpenAI(api_key=key, base_url=base_url, timeout=self.timeout,
+                                    max_retries=0, http_client=shared_http_client()) # we retry ourselves
 
         self.stream_by_default = stream_by_default
-        self.done_streaming = False
-        self.current_stream = '' # this can be popped to the client
-        self.assembled_stream = '' # the full streamed reply, regardless of the above
+        self.stream_lock = threading.Lock() # one stream at a time per object
+        self.done_streaming = threading.Event()
+        self.done_streaming.set()
+        self.stream_chunks = [] # the full streamed reply, delta by delta
+        self.pending_chunks = queue.Queue() # deltas not yet handed to the client; None ends a stream
 
         self.received_reply = ''
+        self.last_usage = None
 
-        self.context = [self.format("system", assignment)] if assignment else []
+        # The pinned messages open every query, always in the same order and
+        # byte for byte, so that providers can cache that prefix.
+        self.pinned = [self.format("system", assignment)] if assignment else []
 
         while sample_exchanges:
             user_message      = sample_exchanges.pop(0)
             assistant_message = sample_exchanges.pop(0)
-            self.context.extend([self.format("user",      user_message),
-                                 self.format("assistant", assistant_message)])
+            self.pinned.extend([self.format("user",      user_message),
+                                self.format("assistant", assistant_message)])
+
+        # With `conversational`, every exchange is remembered in `history`;
+        # the oldest ones fall out of the context to keep it under `context_budget`.
+        self.conversational = conversational
+        self.context_budget = context_budget or DEFAULT_CONTEXT_BUDGET
+        self.history = []
+        self.history_tokens = []
 
     def format(self, role:str, content:str) -> dict:
         """
@@ -45,16 +701,70 @@ class Gpt:
 
         return {"role": role, "content": content}
 
-    def update_context(self, message:dict[str], updated_context:list[dict]=None) -> None:
-        # TODO: currently unused
-        self.context = (updated_context or self.context) + [message]
+    @property
+    def context(self) -> list[dict]:
+        return self.pinned + self.history
+
+    @context.setter
+    def context(self, messages:list[dict]) -> None:
+        self.pinned = list(messages)
+        self.forget()
+
+    def context_tokens(self) -> int:
+        return estimate_prompt_tokens(self.pinned) + sum(self.history_tokens)
+
+    def update_context(self, message:dict[str]) -> None:
+        """
+        Adds `message` to the conversation. Past the budget, whole exchanges
+        are dropped from its start, enough of them at once that the context
+        then stays unchanged (and cacheable) for a good while. An exchange
+        over the budget by itself goes too: the history never starts with
+        an assistant's reply.
+        """
+
+        self.history.append(message)
+        self.history_tokens.append(estimate_message_tokens(message))
+
+        tokens = self.context_tokens()
+        if tokens > self.context_budget:
+            target = self.context_budget * CONTEXT_TRIM_TARGET
+            dropped = 0
+            while dropped < len(self.history) and (tokens > target or self.history[dropped]["role"] != "user"):
+                tokens -= self.history_tokens[dropped]
+                dropped += 1
+            del self.history[:dropped], self.history_tokens[:dropped]
+
+    def forget(self, messages:int=None) -> None:
+        """
+        Drops the last `messages` messages of the conversation, or all of it.
+        """
+
+        keep = max(len(self.history) - messages, 0) if messages else 0
+        del self.history[keep:], self.history_tokens[keep:]
+
+    @property
+    def assembled_stream(self) -> str:
+        return "".join(self.stream_chunks)
 
     def pop_chunks(self) -> str:
-        popped = self.current_stream
-        self.current_stream = self.current_stream[len(popped):]
-        return popped
+        """
+        Everything streamed since the last call, without waiting for more.
+        """
+
+        popped = []
+        while True:
+            try:
+                delta = self.pending_chunks.get_nowait()
+            except queue.Empty:
+                return "".join(popped)
+            if delta is not None:
+                popped.append(delta)
+
+    def query(self, message:str, stream:bool=None, temperature:float=None) -> str:
+        """
+        Raises a GptError once retries are exhausted.
+        """
 
-    def query(self, message:str, stream:bool=None, temperature:float=None):
         self.received_reply = ''
         self.last_query_time = time.time()
         stream = stream if stream is not None else self.stream_by_default
@@ -62,81 +772,603 @@ class Gpt:
 
         contextualized_query = self.context + [self.format("user", message)]
 
-        try:
-            reply = self.create_completion(contextualized_query, stream, temperature)
-            # self.context = contextualized_query + [self.format("assistant", reply)]
-            self.received_reply = reply
+        reply = self.create_completion(contextualized_query, stream, temperature)
+        if self.conversational:
+            self.update_context(contextualized_query[-1])
+            self.update_context(self.format("assistant", reply))
+        self.received_reply = reply
+        return self.received_reply
+
+    def stream(self, message:str, temperature:float=None, examples:list[dict]=None):
+        """
+        Starts streaming the reply to `message` right away and returns a
+        generator of its deltas, which blocks until each one arrives.
+        Errors are raised from the generator once the stream ends.
+        `examples` are messages slipped in between the context and `message`.
+        """
+
+        temperature = temperature if temperature is not None else self.temperature
+        contextualized_query = self.context + (examples or []) + [self.format("user", message)]
+        pending = queue.Queue()
+        errors = []
+
+        def produce():
+            try:
+                if self.hedge is None:
+                    self.received_reply = self.create_completion(contextualized_query, True, temperature, pending)
+                else:
+                    self.received_reply = self.race(contextualized_query, temperature, pending)
+                if self.conversational:
+                    self.update_context(contextualized_query[-1])
+                    self.update_context(self.format("assistant", self.received_reply))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                pending.put(None)
+
+        self.received_reply = ''
+        self.last_query_time = time.time()
+        threading.Thread(target=produce, daemon=True).start()
+
+        def consume():
+            while (delta := pending.get()) is not None:
+                yield delta
+            if errors:
+                raise errors[0]
+
+        return consume()
+
+    def hedge_delay(self) -> float:
+        """
+        How long a stream may go without a first token before it's hedged:
+        the HEDGE_PERCENTILE of the latest times to first token.
+        """
+
+        if len(self.first_token_times) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return percentile(sorted(self.first_token_times), HEDGE_PERCENTILE)
+
+    def race(self, messages:list[dict], temperature:float, pending:queue.Queue) -> str:
+        """
+        Streams `messages` from this model and, once hedge_delay() passes
+        without a token (or right away if this model fails first), from
+        `hedge` too. The first stream to produce a token wins: its deltas go
+        to `pending`, and the other one is cancelled.
+        """
+
+        events = queue.Queue() # (lane, "delta" | "done" | "error", value)
+        cancelled = {self: threading.Event(), self.hedge: threading.Event()}
+        started, running = {}, set() # started: {lane: when}
+        winner, first_error = None, None
+
+        def run(lane):
+            lane_pending = SimpleNamespace(put=lambda delta: events.put((lane, "delta", delta)))
+            try:
+                reply = lane.create_completion(messages, True, temperature, lane_pending, cancelled[lane])
+                events.put((lane, "done", reply))
+            except Exception as e:
+                events.put((lane, "error", e))
+
+        def start(lane):
+            started[lane] = time.perf_counter()
+            running.add(lane)
+            if lane is self.hedge:
+                self.hedges_sent += 1
+            threading.Thread(target=run, args=(lane,), daemon=True).start()
+
+        def cancel(lane):
+            cancelled[lane].set()
+            if lane is self: # it had no token yet: that took at least this long, which hedge_delay() should know
+                self.first_token_times.append(time.perf_counter() - started[self])
+            response = lane.streaming_response
+            if response is not None:
+                try:
+                    response.close() # unblocks a stream still waiting for its next chunk
+                except Exception:
+                    pass
+
+        start(self)
+        deadline = time.monotonic() + self.hedge_delay()
+        while True:
+            hedging = winner is None and self.hedge not in started
+            try:
+                lane, kind, value = events.get(timeout=max(deadline - time.monotonic(), 0) if hedging else None)
+            except queue.Empty:
+                start(self.hedge)
+                continue
+
+            if winner is None and kind != "error":
+                winner = lane
+                if lane is self.hedge:
+                    self.hedges_won += 1
+                for other in running - {lane}:
+                    cancel(other)
+            if winner is not None and lane is not winner:
+                continue # the loser winding down
+
+            if kind == "delta":
+                pending.put(value)
+            elif kind == "done":
+                return value
+            else:
+                running.discard(lane)
+                if lane is winner:
+                    raise value
+                first_error = first_error or value
+                if running:
+                    continue # the other one may still make it
+                if self.hedge not in started: # no point waiting out the delay
+                    start(self.hedge)
+                    continue
+                raise first_error
+
+    def uncache(self, message:str, temperature:float=None) -> None:
+        """
+        Drops the cached reply to `message` (in this object's context), e.g. one
+        the caller found unusable, so that asking again reaches the model.
+        """
+
+        if self.cache is None:
+            return
+        temperature = temperature if temperature is not None else self.temperature
+        self.cache.discard(self.cache.key(self.model, temperature, self.context + [self.format("user", message)]))
+
+    def query_many(self, messages:list[str], concurrency:int=None, temperature:float=None,
+                   return_exceptions:bool=False) -> list[str]:
+        """
+        Sends independent queries (sharing this object's context) at most
+        `concurrency` at a time; replies come back in the order of `messages`.
+        With `return_exceptions`, a failed query's GptError takes the place
+        of its reply instead of being raised.
+        """
+
+        async def run():
+            agpt = AsyncGpt(model=self.model, temperature=self.temperature,
+                            query_timeout=self.query_timeout, concurrency=concurrency,
+                            base_url=self.base_url, key=self.key, cache=self.cache,
+                            max_retries=self.max_retries, rate_limiter=self.rate_limiter,
+                            metrics=self.metrics, tracer=self.tracer, single_flight=self.single_flight)
+            agpt.context = self.context
+            try:
+                return await agpt.aquery_many(messages, temperature=temperature,
+                                              return_exceptions=return_exceptions)
+            finally:
+                await agpt.aclient.close()
+
+        return asyncio.run(run())
+
+    def create_completion(self, messages, stream, temperature, pending:queue.Queue=None,
+                          cancelled:threading.Event=None) -> None:
+        # A racing lane may have to wait for the previous race's loser to wind down.
+        if stream and not self.stream_lock.acquire(timeout=self.query_timeout if cancelled is not None else 0):
+            raise RuntimeError("There is already a completion being streamed.")
+
+        record = new_record(self.model, stream)
+        flight, leading = None, False
+        with self.traced(record) as span:
+            try:
+                if self.cache is not None:
+                    cache_key = self.cache.key(self.model, temperature, messages)
+                    cached_reply = self.cache.get(cache_key)
+                    if cached_reply is not None:
+                        record["cached"] = True
+                        return self.stream_completion(replay_stream(cached_reply), pending) if stream else cached_reply
+
+                if self.single_flight: # a racing stream may be cancelled, so it doesn't lead flights
+                    key = flight_key(self.base_url, self.model, temperature, messages)
+                    flight, leading = join_flight(key, lead=cancelled is None)
+                    if flight is not None and not leading:
+                        record["shared"] = True
+                        reply = self.stream_completion(flight.chunks(), pending, record, cancelled) if stream \
+                                else flight.result()
+                        self.measure(record, reply, None)
+                        return reply
+
+                estimated_tokens = estimate_prompt_tokens(messages)
+                response = self.request_completion(estimated_tokens, record, cancelled, messages=messages,
+                                                   stream=stream, temperature=temperature)
+
+                if stream:
+                    reply = self.stream_completion(flight.relay(response) if leading else response,
+                                                   pending, record, cancelled)
+                    usage = self.last_usage
+                else:
+                    reply = response.choices[0].message.content
+                    usage = response.usage
+                self.measure(record, reply, usage)
+                if stream:
+                    self.first_token_times.append(record["ttft"])
+                if leading:
+                    flight.finish(reply)
+
+                if self.rate_limiter is not None and usage is not None:
+                    self.rate_limiter.reconcile(estimated_tokens, usage.total_tokens)
+
+            except openai.OpenAIError as e:
+                error = typed_error(e)
+                record["error"] = type(error).__name__
+                if leading:
+                    flight.finish(error=error)
+                raise error from e
+
+            except BaseException as e:
+                record["error"] = type(e).__name__
+                if leading and not flight.done:
+                    flight.finish(error=e)
+                raise
+
+            finally:
+                if leading:
+                    land_flight(key)
+                if stream:
+                    self.stream_lock.release()
+                self.emit(record, span)
+
+        if self.cache is not None:
+            self.cache.put(cache_key, reply)
+
+        return reply
+
+    def measure(self, record:dict, reply:str, usage) -> None:
+        """
+        Completes a request's record once its whole reply is in.
+        """
+
+        record["latency"] = time.perf_counter() - record["_clock"]
+        if record["ttft"] is None:
+            record["ttft"] = record["latency"]
+        if usage is not None:
+            record["prompt_tokens"] = usage.prompt_tokens
+            record["completion_tokens"] = usage.completion_tokens
+        output_tokens = record["completion_tokens"] or estimate_tokens(reply or "")
+        generating = record["latency"] - record["ttft"] if record["stream"] else record["latency"]
+        if generating > 0:
+            record["tokens_per_second"] = output_tokens / generating
+
+    def traced(self, record:dict):
+        """
+        A span around one request, if there's a tracer (anything with
+        OpenTelemetry's `start_as_current_span`), else a no-op.
+        """
+
+        if self.tracer is None:
+            return contextlib.nullcontext()
+        return self.tracer.start_as_current_span("gpt.chat_completion",
+                                                 attributes={"gpt.model": record["model"],
+                                                             "gpt.stream": record["stream"]})
+
+    def emit(self, record:dict, span=None) -> None:
+        """
+        Hands a finished request's record to its span and every metrics sink.
+        A failing sink is reported but never fails the request.
+        """
 
-        except openai.APIConnectionError:
-            self.received_reply = "Connection error."
+        del record["_clock"]
+        if span is not None:
+            for name, value in record.items():
+                if value is not None and name not in ("model", "stream", "started"):
+                    span.set_attribute(f"gpt.{name}", value)
+
+        for sink in self.metrics:
+            try:
+                sink(record)
+            except Exception as e:
+                warnings.warn(f"metrics sink {sink!r} failed: {e}")
+
+    def request_completion(self, estimated_tokens:int=0, record:dict=None, cancelled:threading.Event=None,
+                           **kwargs):
+        """
+        Waits for the rate limiter, if any, and retries throttled, failing
+        or unreachable requests with backoff.
+        A stream is only retried until its response headers arrive.
+        The waits and retries are counted in `record`, if any.
+        Once `cancelled` is set, neither backoff nor retries go on: it raises
+        a GptCancelledError instead.
+        """
+
+        if (self.rate_limiter is not None or self.metrics) and kwargs.get("stream"):
+            kwargs["stream_options"] = {"include_usage": True} # to reconcile the estimate, and to count
+
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                waited = self.rate_limiter.acquire(estimated_tokens)
+                if record is not None:
+                    record["queue_wait"] += waited
+            if cancelled is not None and cancelled.is_set():
+                raise GptCancelledError("Lost the race to another stream.")
+            try:
+                if cancelled is not None:
+                    return self.cancellable_create(cancelled, **kwargs)
+                return self.client.chat.completions.create(model=self.model, **kwargs)
+            except openai.OpenAIError as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                if cancelled is not None:
+                    if cancelled.wait(retry_delay(attempt, e)):
+                        raise GptCancelledError("Lost the race to another stream.") from e
+                else:
+                    time.sleep(retry_delay(attempt, e))
+                attempt += 1
+                if record is not None:
+                    record["retries"] = attempt
+
+    def cancellable_create(self, cancelled:threading.Event, **kwargs):
+        """
+        Sends the request from a thread of its own, so that waiting for its
+        response headers stops as soon as `cancelled` is set, with a
+        GptCancelledError. The abandoned response is closed once it arrives.
+        """
+
+        outcome = {}
+        lock, done = threading.Lock(), threading.Event()
+
+        def send():
+            try:
+                outcome["response"] = self.client.chat.completions.create(model=self.model, **kwargs)
+            except Exception as e:
+                outcome["error"] = e
+            with lock:
+                done.set()
+                abandoned = outcome.get("abandoned")
+            if abandoned and hasattr(outcome.get("response"), "close"):
+                outcome["response"].close()
+
+        threading.Thread(target=send, daemon=True).start()
+        while not done.wait(CANCEL_POLL_INTERVAL):
+            if cancelled.is_set():
+                with lock:
+                    if not done.is_set():
+                        outcome["abandoned"] = True
+                        raise GptCancelledError("Lost the race to another stream.")
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome["response"]
+
+    def stream_completion(self, response, pending:queue.Queue=None, record:dict=None,
+                          cancelled:threading.Event=None) -> str:
+        """
+        Collects the received stream into `stream_chunks` and hands every
+        delta to `pending` (by default `pending_chunks`) as it arrives,
+        so that a client can process the stream before it's done.
+        The first delta's arrival is the `record`'s time to first token.
+        Once `cancelled` is set, the stream is dropped with a GptCancelledError.
+        """
+
+        pending = pending or self.pending_chunks
+        self.done_streaming.clear()
+        self.stream_chunks = []
+        self.last_usage = None
+        self.streaming_response = response
+
+        try:
+            if cancelled is not None and cancelled.is_set(): # while waiting for the response
+                raise GptCancelledError("Lost the race to another stream.")
+            for chunk in response:
+                if cancelled is not None and cancelled.is_set():
+                    raise GptCancelledError("Lost the race to another stream.")
+                if getattr(chunk, "usage", None):
+                    self.last_usage = chunk.usage
+                if not chunk.choices: # e.g. a trailing usage-only chunk
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if record is not None and record["ttft"] is None:
+                        record["ttft"] = time.perf_counter() - record["_clock"]
+                    self.stream_chunks.append(delta)
+                    pending.put(delta)
 
         except Exception as e:
-            self.received_reply = f"Error: {e}"
+            if cancelled is None or not cancelled.is_set():
+                raise
+            response.close()
+            if isinstance(e, GptCancelledError):
+                raise
+            raise GptCancelledError("Lost the race to another stream.") from e # closed under its feet
 
         finally:
-            return self.received_reply
+            self.streaming_response = None
+            if pending is self.pending_chunks:
+                pending.put(None)
+            self.done_streaming.set()
 
-            # else:
-            #     time_elapsed = time.time() - self.last_query_time
-            #     if time_elapsed > self.query_timeout:
-            #         return f"Query timed out after {time_elapsed} s."
+        return self.assembled_stream
 
-    def create_completion(self, messages, stream, temperature) -> None:
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            stream=stream,
-            temperature=temperature,
-        )
+    def batch_line(self, custom_id:str, message:str, temperature:float=None) -> dict:
+        """
+        A query (with this object's context) as one line of a batch job's
+        JSONL input file, to be matched with its result by `custom_id`.
+        """
 
-        if stream:
-            if not self.done_streaming:
-                raise Exception("There is already a completion being streamed.")
+        temperature = temperature if temperature is not None else self.temperature
+        return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+                "body": {"model": self.model, "temperature": temperature,
+                         "messages": self.context + [self.format("user", message)]}}
 
-            return self.stream_completion(response)
+    def submit_batch(self, path:str, metadata:dict=None) -> str:
+        """
+        Uploads a JSONL file of batch_line()s and starts a batch job on it,
+        whose results come within BATCH_COMPLETION_WINDOW, at a discount.
+        Returns the job's id.
+        """
 
-        else:
-            return response.choices[0].message.content
+        client = self.client.with_options(timeout=BATCH_TIMEOUT)
+        try:
+            with open(path, "rb") as batch_file:
+                input_file = client.files.create(file=batch_file, purpose="batch")
+            return client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions",
+                                         completion_window=BATCH_COMPLETION_WINDOW, metadata=metadata).id
+        except openai.OpenAIError as e:
+            raise typed_error(e) from e
 
-    def stream_completion(self, response) -> str:
+    def batch_status(self, batch_id:str):
         """
-        Runs asynchronously, incorporating the received stream into the
-        object so that a client can pop out its current state and iteratively
-        process the stream before its done.
+        The batch job, whose `status` is final once in BATCH_FINAL_STATUSES.
         """
 
-        self.done_streaming = False
-        self.current_stream = ''
-        self.assembled_stream = ''
+        try:
+            return self.client.batches.retrieve(batch_id)
+        except openai.OpenAIError as e:
+            raise typed_error(e) from e
 
-        for chunk in response:
-        # TODO how does this work on the api? when does it stop?
-            choice = chunk.choices[0]
-            delta = choice.delta.content
-            if delta is not None:
-                self.current_stream += delta
-                self.assembled_stream += delta
+    def batch_results(self, batch) -> dict:
+        """
+        {custom_id: reply} of a finished batch job; a request that failed
+        has a GptStatusError instead, and one that never ran is missing.
+        """
 
-        self.done_streaming = True
+        client = self.client.with_options(timeout=BATCH_TIMEOUT)
+        results = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            try:
+                content = client.files.content(file_id).text
+            except openai.OpenAIError as e:
+                raise typed_error(e) from e
 
-        return self.assembled_stream
+            for line in content.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if response.get("status_code") == 200:
+                    results[result["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+                else:
+                    error = (response.get("body") or {}).get("error") or result.get("error") or {}
+                    results[result["custom_id"]] = GptStatusError(error.get("message", "batch request failed"),
+                                                                  response.get("status_code"))
+        return results
 
     def loop(self) -> None:
+        self.conversational = True
         integer_temp = 0
 
-        # last_input = ""
+        last_input = ""
         while True:
             new_input = input("> ").strip()
             if new_input:
                 integer_temp = 0
                 last_input = new_input
-            else:
+            elif last_input:
                 integer_temp += 2 # if blank then regenerate, but hotter
+                self.forget(2)    # replacing the last exchange
 
             if last_input:
-                reply = self.ask( last_input, (integer_temp%11)/10 ) # magic lost to oblivion
+                try:
+                    reply = self.query(last_input, temperature=(integer_temp%11)/10) # magic lost to oblivion
+                except GptError as e:
+                    reply = f"<<{type(e).__name__}: {e}>>"
                 print("\n" + reply)
 
 
+class AsyncGpt(Gpt):
+    """
+    Gpt on top of the async OpenAI client, for fanning out many
+    independent (non-streamed) queries at once.
+    """
+
+    def __init__(self, *args, concurrency:int=None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.concurrency = concurrency or DEFAULT_CONCURRENCY
+        self.aclient = openai.AsyncOpenAI(api_key=self.key, base_url=self.base_url, timeout=self.timeout,
+                                          max_retries=0, http_client=httpx.AsyncClient(limits=POOL_LIMITS))
+
+    async def arequest_completion(self, estimated_tokens:int=0, record:dict=None, **kwargs):
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                waited = await asyncio.to_thread(self.rate_limiter.acquire, estimated_tokens)
+                if record is not None:
+                    record["queue_wait"] += waited
+            try:
+                return await self.aclient.chat.completions.create(model=self.model, **kwargs)
+            except openai.OpenAIError as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                await asyncio.sleep(retry_delay(attempt, e))
+                attempt += 1
+                if record is not None:
+                    record["retries"] = attempt
+
+    async def aquery(self, message:str, temperature:float=None, queued_since:float=None) -> str:
+        """
+        `queued_since` (a perf_counter time) backdates the request's
+        metrics to when it started waiting for a free slot.
+        """
+
+        temperature = temperature if temperature is not None else self.temperature
+        contextualized_query = self.context + [self.format("user", message)]
+
+        record = new_record(self.model, False)
+        if queued_since is not None:
+            record["queue_wait"] = record["_clock"] - queued_since
+            record["_clock"] = queued_since
+
+        flight, leading = None, False
+        with self.traced(record) as span:
+            try:
+                if self.cache is not None:
+                    cache_key = self.cache.key(self.model, temperature, contextualized_query)
+                    cached_reply = self.cache.get(cache_key)
+                    if cached_reply is not None:
+                        record["cached"] = True
+                        return cached_reply
+
+                if self.single_flight:
+                    key = flight_key(self.base_url, self.model, temperature, contextualized_query)
+                    flight, leading = join_flight(key)
+                    if not leading:
+                        record["shared"] = True
+                        reply = await flight.aresult()
+                        self.measure(record, reply, None)
+                        return reply
+
+                estimated_tokens = estimate_prompt_tokens(contextualized_query)
+                response = await self.arequest_completion(estimated_tokens, record, messages=contextualized_query,
+                                                          temperature=temperature)
+                reply = response.choices[0].message.content
+                self.measure(record, reply, response.usage)
+                if leading:
+                    flight.finish(reply)
+
+            except openai.OpenAIError as e:
+                error = typed_error(e)
+                record["error"] = type(error).__name__
+                if leading:
+                    flight.finish(error=error)
+                raise error from e
+
+            except BaseException as e:
+                record["error"] = type(e).__name__
+                if leading and not flight.done:
+                    flight.finish(error=e)
+                raise
+
+            finally:
+                if leading:
+                    land_flight(key)
+                self.emit(record, span)
+
+        if self.rate_limiter is not None and response.usage is not None:
+            self.rate_limiter.reconcile(estimated_tokens, response.usage.total_tokens)
+
+        if self.cache is not None:
+            self.cache.put(cache_key, reply)
+        return reply
+
+    async def aquery_many(self, messages:list[str], concurrency:int=None, temperature:float=None,
+                          return_exceptions:bool=False) -> list[str]:
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+
+        async def bounded_query(message):
+            queued_since = time.perf_counter()
+            async with semaphore:
+                return await self.aquery(message, temperature, queued_since)
+
+        return await asyncio.gather(*(bounded_query(message) for message in messages),
+                                    return_exceptions=return_exceptions)
+
+
 if __name__ == '__main__':
     Gpt().loop()
\ No newline at end of file
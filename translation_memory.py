@@ -0,0 +1,148 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+
+SHINGLE_SIZE = 4 # characters per shingle
+BANDS = 8        # the MinHash signature is BANDS * ROWS values; two texts become
+ROWS = 4         # fuzzy candidates when all ROWS values of any band coincide
+MERSENNE_PRIME = (1 << 61) - 1
+PERMUTATIONS = [(int.from_bytes(hashlib.blake2b(f"a{n}".encode(), digest_size=8).digest(), "big") | 1,
+                 int.from_bytes(hashlib.blake2b(f"b{n}".encode(), digest_size=8).digest(), "big"))
+                for n in range(BANDS * ROWS)]
+
+
+def normalize(text:str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+def shingles(text:str) -> set[str]:
+    text = normalize(text).casefold()
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[n:n+SHINGLE_SIZE] for n in range(len(text) - SHINGLE_SIZE + 1)}
+
+def similarity(a:set, b:set) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+def signature(text_shingles:set[str]) -> list[int]:
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big")
+              for shingle in text_shingles]
+    return [min((a * h + b) % MERSENNE_PRIME for h in hashes) for a, b in PERMUTATIONS]
+
+def band_keys(language:str, text_shingles:set[str]) -> list[str]:
+    values = signature(text_shingles)
+    return [f"{language}|{band}|" + ",".join(map(str, values[band * ROWS:(band + 1) * ROWS]))
+            for band in range(BANDS)]
+
+
+class TranslationMemory:
+    """
+    Translated segments on disk, looked up by target language and source text:
+    exactly (by hash of the whitespace-normalized source) or, failing that,
+    fuzzily (MinHash over character shingles, banded so only likely matches
+    are compared) for the closest source at least `threshold` similar.
+    Beyond `max_entries`, the least recently used segments are dropped.
+    """
+
+    def __init__(self, path:str, max_entries:int=None, threshold:float=.8) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.exact_hits = 0
+        self.fuzzy_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS segments (
+                id          INTEGER PRIMARY KEY,
+                key         TEXT UNIQUE NOT NULL,
+                language    TEXT NOT NULL,
+                source      TEXT NOT NULL,
+                translation TEXT NOT NULL,
+                last_used   REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS bands (
+                band       TEXT NOT NULL,
+                segment_id INTEGER NOT NULL REFERENCES segments (id) ON DELETE CASCADE);
+            CREATE INDEX IF NOT EXISTS bands_band ON bands (band);
+            CREATE INDEX IF NOT EXISTS bands_segment ON bands (segment_id);
+            CREATE INDEX IF NOT EXISTS segments_last_used ON segments (last_used);
+        """)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.commit()
+
+    @staticmethod
+    def key(language:str, source:str) -> str:
+        return hashlib.sha256(f"{language}\n{normalize(source)}".encode()).hexdigest()
+
+    def lookup(self, language:str, source:str) -> tuple[str, str, float, bool] | None:
+        """
+        Returns (translation, the source it translates, similarity, exact).
+        Only an exact match (by key) can be reused as is: a fuzzy one may
+        score 1.0 while differing in case or in repeated shingles.
+        """
+
+        with self.lock:
+            row = self.db.execute("SELECT id, source, translation FROM segments WHERE key = ?",
+                                  (self.key(language, source),)).fetchone()
+            if row:
+                self.exact_hits += 1
+                self.touch(row[0])
+                return row[2], row[1], 1.0, True
+
+            source_shingles = shingles(source)
+            keys = band_keys(language, source_shingles)
+            candidates = self.db.execute(f"""SELECT DISTINCT segments.id, source, translation
+                                             FROM bands JOIN segments ON segments.id = bands.segment_id
+                                             WHERE band IN ({",".join("?" * len(keys))})""", keys).fetchall()
+
+            best, best_similarity = None, self.threshold
+            for candidate in candidates:
+                candidate_similarity = similarity(source_shingles, shingles(candidate[1]))
+                if candidate_similarity >= best_similarity:
+                    best, best_similarity = candidate, candidate_similarity
+
+            if best is None:
+                self.misses += 1
+                return None
+            self.fuzzy_hits += 1
+            self.touch(best[0])
+            return best[2], best[1], best_similarity, False
+
+    def touch(self, segment_id:int) -> None:
+        """ Call with the lock held. """
+
+        self.db.execute("UPDATE segments SET last_used = ? WHERE id = ?", (time.time(), segment_id))
+        self.db.commit()
+
+    def add(self, language:str, source:str, translation:str) -> None:
+        key = self.key(language, source)
+        keys = band_keys(language, shingles(source))
+        with self.lock:
+            self.db.execute("DELETE FROM segments WHERE key = ?", (key,))
+            segment_id = self.db.execute("""INSERT INTO segments (key, language, source, translation, last_used)
+                                            VALUES (?, ?, ?, ?, ?)""",
+                                         (key, language, normalize(source), translation, time.time())).lastrowid
+            self.db.executemany("INSERT INTO bands VALUES (?, ?)", [(band, segment_id) for band in keys])
+            if self.max_entries is not None:
+                self.db.execute("""DELETE FROM segments WHERE id IN (
+                                       SELECT id FROM segments ORDER BY last_used DESC LIMIT -1 OFFSET ?)""",
+                                (self.max_entries,))
+            self.db.commit()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM segments").fetchone()[0]
+
+    def stats(self) -> dict:
+        lookups = self.exact_hits + self.fuzzy_hits + self.misses
+        return {"exact_hits": self.exact_hits, "fuzzy_hits": self.fuzzy_hits, "misses": self.misses,
+                "entries": len(self),
+                "exact_hit_rate": self.exact_hits / lookups if lookups else 0.0,
+                "hit_rate": (self.exact_hits + self.fuzzy_hits) / lookups if lookups else 0.0}
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
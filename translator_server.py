@@ -0,0 +1,440 @@
+from gpt_lib import Gpt, GptError, ResponseCache, estimate_tokens
+from translator import (SERVER_TIMEOUT, HOST, CACHE_SIZE, SEGMENT_TOKENS, SEGMENT_WORKERS, MEMORY_SIZE,
+                        FUZZY_THRESHOLD, CLIPBOARD_POLL, SPECULATION_DEBOUNCE, SPECULATION_MAX_CHARS,
+                        SPECULATIONS_PER_MINUTE, SPECULATION_TOKENS_PER_HOUR, SPECULATIONS_KEPT,
+                        WRITE_FLUSH_INTERVAL, WRITE_MAX_PENDING, MODEL, HEDGE_MODEL,
+                        PORTFILE, STRMFILE, CACHEFILE, MEMORYFILE, remove_if_exists, send_frame, receive_frame)
+from translation_memory import TranslationMemory
+import os
+import pyperclip
+import re
+import time
+import queue
+import socket
+import keyboard
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from windows_toasts import Toast, WindowsToaster, ToastDuration
+
+MODIFIERS = ("ctrl", "alt", "shift", "windows")
+
+def announce_completion(t0):
+    print(f"  completed in [{time.time() - t0:.1f}] s\n")
+    return time.time()
+
+def wait_for_release(timeout:float=1):
+    """
+    Waits (not past `timeout`) for the hotkey's modifiers to be let go,
+    since typing while they're held would fire shortcuts instead.
+    """
+
+    deadline = time.monotonic() + timeout
+    while any(keyboard.is_pressed(key) for key in MODIFIERS) and time.monotonic() < deadline:
+        time.sleep(.01)
+
+def split_keeping_separators(text:str, separator:str) -> list[str]:
+    """
+    Splits `text` after each match of the `separator` pattern, which stays
+    attached to the piece before it; the pieces join back into `text`.
+    """
+
+    parts = re.split(f"({separator})", text)
+    return ["".join(parts[n:n+2]) for n in range(0, len(parts), 2) if "".join(parts[n:n+2])]
+
+def segment(text:str, budget:int=SEGMENT_TOKENS) -> list[str]:
+    """
+    Cuts `text` at paragraph breaks (and, within overlong paragraphs, at
+    sentence ends) into segments of at most about `budget` tokens.
+    Whitespace stays in the segments, so they join back into `text`.
+    """
+
+    units = []
+    for paragraph in split_keeping_separators(text, r"\n\s*\n"):
+        if estimate_tokens(paragraph) > budget:
+            units += split_keeping_separators(paragraph, r"(?<=[.!?…。])\s+")
+        else:
+            units.append(paragraph)
+
+    segments, current, tokens = [], "", 0
+    for unit in units:
+        unit_tokens = estimate_tokens(unit)
+        if current and tokens + unit_tokens > budget:
+            segments.append(current)
+            current, tokens = "", 0
+        current += unit
+        tokens += unit_tokens
+    return segments + [current] if current else segments
+
+
+class Toaster(WindowsToaster):
+    def __init__(self, name):
+        super().__init__(name)
+
+    def __call__(self, text, attribution_text=None, duration=ToastDuration.Long, clear=True):
+        if clear:
+            self.clear_toasts()
+
+        print(f"{[text]}")
+        if attribution_text:
+            print(f"{attribution_text}\n")
+        print()
+
+        if attribution_text:
+            attribution_text = attribution_text[:500]
+
+        toast = Toast([text[:500]], attribution_text=attribution_text, duration=duration)
+        self.show_toast(toast)
+
+
+class KeystrokeWriter:
+    """
+    Types text from a single long-lived thread. Whatever arrives while a
+    write is under way is coalesced into the next keyboard.write call, and
+    `write` blocks while more than `max_pending` characters wait to be typed.
+    """
+
+    def __init__(self, flush_interval:float=WRITE_FLUSH_INTERVAL, max_pending:int=WRITE_MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.buffer = []
+        self.pending = 0 # characters handed in but not typed yet
+        self.writes = 0
+        self.condition = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def write(self, text:str):
+        if not text:
+            return
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending < self.max_pending)
+            self.buffer.append(text)
+            self.pending += len(text)
+            self.condition.notify_all()
+
+    def flush(self):
+        """ Blocks until everything written so far has been typed. """
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending == 0)
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.buffer)
+                text = "".join(self.buffer)
+                self.buffer = []
+
+            try:
+                keyboard.write(text)
+            except Exception as e:
+                print(f"<<Can't type: {e}>>")
+
+            with self.condition:
+                self.pending -= len(text)
+                self.writes += 1
+                self.condition.notify_all()
+            time.sleep(self.flush_interval)
+
+
+class Speculation:
+    """
+    A translation started before anyone asked for it. It keeps every delta,
+    so a reader who comes in late replays them and then follows it live.
+    """
+
+    def __init__(self, deltas):
+        self.deltas = []
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+        threading.Thread(target=self.collect, args=(deltas,), daemon=True).start()
+
+    def collect(self, deltas):
+        try:
+            for delta in deltas:
+                with self.condition:
+                    self.deltas.append(delta)
+                    self.condition.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def follow(self):
+        read = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.done or len(self.deltas) > read)
+                new_deltas = self.deltas[read:]
+                finished = self.done
+            read += len(new_deltas)
+            yield from new_deltas
+            if finished and read == len(self.deltas):
+                if self.error:
+                    raise self.error
+                return
+
+
+class Translator_Server:
+    def __init__(self, target_language:str, assignment:str, modes:str, toaster:Toaster):
+        toaster(f"Initializing server…")
+
+        self.target_language = target_language
+        self.modes = modes
+        self.last_query = None
+        cache = ResponseCache(CACHEFILE, max_entries=CACHE_SIZE)
+        self.gpts = queue.Queue() # one per worker, since a Gpt streams one reply at a time
+        for _ in range(SEGMENT_WORKERS):
+            self.gpts.put(Gpt(assignment, model=MODEL, cache=cache,
+                              hedge=Gpt(assignment, model=HEDGE_MODEL, cache=cache)))
+        self.segment_pool = ThreadPoolExecutor(SEGMENT_WORKERS)
+        self.speculation_pool = ThreadPoolExecutor(1) # speculations get a worker and a Gpt of their own,
+        self.speculation_gpts = queue.Queue()         # so that hotkey calls never wait behind them
+        self.speculation_gpts.put(Gpt(assignment, model=MODEL, cache=cache,
+                                      hedge=Gpt(assignment, model=HEDGE_MODEL, cache=cache)))
+        self.memory = TranslationMemory(MEMORYFILE, max_entries=MEMORY_SIZE, threshold=FUZZY_THRESHOLD)
+        self.toaster = toaster
+        self.writer = KeystrokeWriter()
+        self.pid = str(os.getpid())
+        self.calls = queue.Queue() # (modes, connection awaiting the result or None)
+        self.speculations = OrderedDict() # (language, text): Speculation
+        self.speculation_log = deque() # (time, estimated tokens) of the last hour's speculations
+        self.last_translation = None
+
+        self.listener = socket.create_server((HOST, 0))
+        with open(PORTFILE, "w") as portfile:
+            portfile.write(str(self.listener.getsockname()[1]))
+        threading.Thread(target=self.listen, daemon=True).start()
+        if "speculate" in self.modes:
+            threading.Thread(target=self.watch_clipboard, daemon=True).start()
+
+        remove_if_exists(STRMFILE) #TODO test for pid
+
+        if "silent" not in self.modes:
+            self.handle_call() # the launching hotkey press is a call like any other
+        else:
+            self.modes = set()
+
+
+    def loop(self):
+        try:
+            while True:
+                try:
+                    call, connection = self.calls.get(timeout=SERVER_TIMEOUT)
+                except queue.Empty:
+                    print(f"Server timed out after {SERVER_TIMEOUT} seconds.")
+                    break
+
+                print(f"Called to action: {call}, previously {self.modes}")
+                self.modes.update(call)
+
+                result = self.handle_call()
+                if connection:
+                    with connection:
+                        try:
+                            send_frame(connection, result)
+                        except OSError:
+                            pass # the client gave up waiting
+
+        finally:
+            self.listener.close()
+            remove_if_exists(PORTFILE, STRMFILE)
+            print(f"Translation memory: {self.memory.stats()}")
+            gpts = list(self.gpts.queue) + list(self.speculation_gpts.queue)
+            print(f"Hedged streams: {sum(gpt.hedges_sent for gpt in gpts)}, "
+                  f"won by {HEDGE_MODEL}: {sum(gpt.hedges_won for gpt in gpts)}")
+
+    def listen(self):
+        while True:
+            try:
+                connection, _ = self.listener.accept()
+            except OSError: # closed on the way out
+                return
+            threading.Thread(target=self.receive_call, args=(connection,), daemon=True).start()
+
+    def receive_call(self, connection:socket.socket):
+        """
+        Acknowledges each call as soon as it is queued; calls that
+        ask to wait keep their connection open for the result.
+        """
+
+        try:
+            request = receive_frame(connection)
+            send_frame(connection, {"status": "queued", "position": self.calls.qsize() + 1})
+        except (OSError, ValueError):
+            connection.close()
+            return
+
+        wait = request.get("wait", False)
+        self.calls.put((set(request.get("modes", [])), connection if wait else None))
+        if not wait:
+            connection.close()
+
+    def handle_call(self) -> dict:
+        """
+        Translates as the current modes say; failures are toasted and
+        returned as the call's result, never raised, so the server stays up.
+        Whatever happens, the modes only last for this call.
+        """
+
+        try:
+            return {"status": "done", "translation": self.translate()}
+        except ValueError as e:
+            print(f"<<Error: {e}>>")
+            return {"status": "error", "error": str(e)}
+        except GptError as e:
+            self.toaster(f"Translation failed: {type(e).__name__}", str(e))
+            return {"status": "error", "error": str(e)}
+        finally:
+            self.modes = set()
+
+    def translate(self, input:str=None):
+        if "paste" in self.modes:
+            return
+
+        with open(STRMFILE, "w") as strmfile:
+            strmfile.write(self.pid)
+
+        input = pyperclip.paste() if input is None else input # TODO not here
+        input = input.strip()
+
+        if not input:
+            raise ValueError("no input")
+
+        self.toaster(f"Translating to {self.target_language}…", input)
+
+        speculation = self.speculations.get((self.target_language, input))
+        if speculation and not speculation.error:
+            deltas = speculation.follow()
+        else:
+            deltas = self.translate_segments(segment(input))
+        wait_for_release()
+
+        translated_chunks = []
+        self.toaster("GO")
+        try:
+            for delta in deltas: # blocks until the next delta arrives
+                translated_chunks.append(delta)
+                print(f"<<{delta}>>", end='')
+                self.writer.write(delta)
+        finally:
+            remove_if_exists(STRMFILE)
+
+        self.writer.flush()
+        translation = "".join(translated_chunks)
+
+        if "copy" in self.modes:
+            pyperclip.copy(translation)
+            self.toaster(f"Translation copied to clipboard", translation, duration=ToastDuration.Short)
+
+        else:
+            self.toaster(f"Translated", translation)
+
+        self.last_query = time.time()
+        self.last_translation = translation.strip()
+        return translation
+
+    def watch_clipboard(self):
+        """
+        Translates whatever is copied, once it has stayed put for a moment,
+        so that the hotkey finds the translation done or under way.
+        """
+
+        seen, seen_since, considered = None, 0, None
+        while True:
+            time.sleep(CLIPBOARD_POLL)
+            try:
+                text = pyperclip.paste().strip()
+            except Exception:
+                continue
+
+            if text != seen:
+                seen, seen_since = text, time.monotonic()
+            elif text != considered and time.monotonic() - seen_since >= SPECULATION_DEBOUNCE:
+                considered = text
+                if text and text != self.last_translation and self.may_speculate(text):
+                    self.speculate(text)
+
+    def may_speculate(self, text:str) -> bool:
+        if len(text) > SPECULATION_MAX_CHARS or (self.target_language, text) in self.speculations:
+            return False
+
+        now = time.monotonic()
+        while self.speculation_log and now - self.speculation_log[0][0] > 3600:
+            self.speculation_log.popleft()
+        last_minute = sum(1 for started, _ in self.speculation_log if now - started <= 60)
+        last_hour_tokens = sum(tokens for _, tokens in self.speculation_log)
+        return (last_minute < SPECULATIONS_PER_MINUTE
+                and last_hour_tokens + estimate_tokens(text) <= SPECULATION_TOKENS_PER_HOUR)
+
+    def speculate(self, text:str):
+        print(f"Speculating on {text[:50]!r}")
+        self.speculation_log.append((time.monotonic(), estimate_tokens(text)))
+        self.speculations[(self.target_language, text)] = Speculation(self.translate_segments(segment(text), speculative=True))
+        while len(self.speculations) > SPECULATIONS_KEPT:
+            self.speculations.popitem(last=False)
+
+    def translate_segments(self, segments:list[str], speculative:bool=False):
+        """
+        Starts translating all `segments` on the worker pool right away and
+        returns a generator of the translation's deltas, strictly in order:
+        the first segment streams live while later ones are buffered.
+        Speculative ones go one at a time through the speculation worker.
+        """
+
+        pool, gpts = (self.speculation_pool, self.speculation_gpts) if speculative else (self.segment_pool, self.gpts)
+
+        outputs = [queue.Queue() for _ in segments]
+
+        def translate_segment(segment, output):
+            """
+            Serves the segment from memory when it was translated before;
+            a merely similar one is shown to the model as an example.
+            """
+
+            body = segment.strip()
+            output.put(segment[:len(segment) - len(segment.lstrip())]) # the model wouldn't keep the whitespace
+            try:
+                remembered = self.memory.lookup(self.target_language, body)
+                if remembered and remembered[3]: # exact
+                    output.put(remembered[0])
+                else:
+                    examples = []
+                    if remembered:
+                        examples = [{"role": "user", "content": f"[{self.target_language}] {remembered[1]}"},
+                                    {"role": "assistant", "content": remembered[0]}]
+                    gpt = gpts.get()
+                    try:
+                        translated_chunks = []
+                        for delta in gpt.stream(f"[{self.target_language}] {body}", examples=examples):
+                            translated_chunks.append(delta)
+                            output.put(delta)
+                    finally:
+                        gpts.put(gpt)
+                    self.memory.add(self.target_language, body, "".join(translated_chunks))
+
+                output.put(segment[len(segment.rstrip()):])
+            except Exception as e:
+                output.put(e)
+            finally:
+                output.put(None)
+
+        for segment_, output in zip(segments, outputs):
+            pool.submit(translate_segment, segment_, output)
+
+        def ordered_deltas():
+            for output in outputs:
+                while (delta := output.get()) is not None:
+                    if isinstance(delta, Exception):
+                        raise delta
+                    if delta:
+                        yield delta
+
+        return ordered_deltas()
+
+    # @atexit.register
+    # def clean_up(self):
+    #     remove_if_exists(STRMFILE, PORTFILE)